@@ -1,9 +1,32 @@
-import json
+import logging
+import time
 import aiosqlite
-from typing import Optional
+from typing import Any, Optional
 from pathlib import Path
 from datetime import datetime
-from backend.app.models.context import LearningContext, create_session_id
+from aiosqlitepool import SQLiteConnectionPool
+from backend.app.core.fastjson import json_dumps as _json_dumps, json_loads as _json_loads
+from backend.app.models.context import (
+    MAX_HISTORY_MESSAGES,
+    LearningContext,
+    ContextMessage,
+    UIState,
+    VisualizationSpec,
+    create_session_id,
+)
+
+logger = logging.getLogger(__name__)
+
+# Module-level bound method: time.time_ns() is far cheaper than building and
+# formatting a datetime, and the integer stores compactly in SQLite.
+_now_ns = time.time_ns
+
+# Cold-session loads only pull the most recent turns; older history stays in
+# the messages table and is never deserialized unless explicitly queried.
+# This matches the in-memory window: loading more would only have the first
+# add_message fold the excess — turns already summarized into
+# rolling_summary in earlier sessions — back into the summary a second time.
+MAX_LOADED_MESSAGES = MAX_HISTORY_MESSAGES
 
 # Define the database file path
 # Use an environment variable or config for this in a real app
@@ -11,81 +34,313 @@ DATABASE_DIR = Path("runtime")
 DATABASE_DIR.mkdir(parents=True, exist_ok=True)
 DATABASE_PATH = DATABASE_DIR / "context.db"
 
-# SQL statement to create the context table
+# SQL statements to create the storage tables.
+# Context metadata and the message history live in separate tables so that
+# appending a message is a single O(1) INSERT instead of rewriting the whole
+# (growing) serialized context blob on every turn.
 CREATE_CONTEXTS_TABLE_SQL = """
 CREATE TABLE IF NOT EXISTS contexts (
     session_id TEXT PRIMARY KEY,
-    context_data TEXT NOT NULL, -- Store JSON representation of LearningContext
-    created_at TEXT,
-    updated_at TEXT
+    ui_state TEXT NOT NULL,            -- JSON of UIState
+    current_topic TEXT,
+    learning_objectives TEXT NOT NULL, -- JSON list
+    last_visualization_spec TEXT,      -- JSON of VisualizationSpec, or NULL
+    last_render_output TEXT,
+    rolling_summary TEXT,              -- condensed evicted history
+    created_at INTEGER,                -- epoch nanoseconds
+    updated_at INTEGER                 -- epoch nanoseconds
+);
+"""
+
+CREATE_MESSAGES_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS messages (
+    session_id TEXT NOT NULL,
+    seq INTEGER NOT NULL,              -- position in the conversation
+    role TEXT NOT NULL,
+    content TEXT NOT NULL,
+    metadata TEXT,                     -- JSON dict, or NULL
+    timestamp INTEGER,                 -- epoch nanoseconds
+    PRIMARY KEY (session_id, seq)
 );
 """
 
+
+async def _create_connection() -> aiosqlite.Connection:
+    """
+    Connection factory for the pool. Opens a connection and applies pragmas
+    tuned for a long-running service: WAL allows concurrent readers during
+    writes, and the enlarged page cache stays warm across requests because
+    pooled connections are reused instead of being closed per operation.
+    """
+    db = await aiosqlite.connect(DATABASE_PATH)
+    await db.execute("PRAGMA journal_mode=WAL")
+    await db.execute("PRAGMA synchronous=NORMAL")
+    await db.execute("PRAGMA busy_timeout=5000")
+    await db.execute("PRAGMA cache_size=-20000")  # ~20MB page cache
+    await db.execute("PRAGMA temp_store=MEMORY")
+    await db.execute("PRAGMA mmap_size=268435456")  # 256MB memory-mapped I/O
+    return db
+
+
+# Module-level connection pool, shared by all SQLiteContextStorage instances.
+# Created lazily by get_connection_pool() so importing this module stays cheap.
+_connection_pool: Optional[SQLiteConnectionPool] = None
+
+
+def get_connection_pool() -> SQLiteConnectionPool:
+    """Returns the shared connection pool, creating it on first use."""
+    global _connection_pool
+    if _connection_pool is None:
+        _connection_pool = SQLiteConnectionPool(connection_factory=_create_connection)
+    return _connection_pool
+
+
 class SQLiteContextStorage:
     """
     Handles persistence of LearningContext objects using SQLite.
-    Uses aiosqlite for async database operations.
+    Uses aiosqlite for async database operations, with connections drawn from
+    a shared pool instead of being opened and closed per operation.
+
+    The message history is stored append-only in its own table; only new
+    messages are written on save, so the per-turn write cost stays constant
+    as a session grows.
     """
     def __init__(self, db_path: Path = DATABASE_PATH):
         self.db_path = db_path
-        self._connection = None # Use this to hold a single connection if needed, or open/close per operation
+        self.pool = get_connection_pool()
 
     async def _init_db(self):
-        """Initializes the database connection and creates tables."""
-        # Use a connection context manager for simple operations
-        async with aiosqlite.connect(self.db_path) as db:
+        """Initializes the database and creates tables."""
+        async with self.pool.connection() as db:
+            await self._migrate_legacy_contexts(db)
             await db.execute(CREATE_CONTEXTS_TABLE_SQL)
+            await db.execute(CREATE_MESSAGES_TABLE_SQL)
+            try:
+                # Databases created before the rolling-summary column existed
+                await db.execute("ALTER TABLE contexts ADD COLUMN rolling_summary TEXT")
+            except aiosqlite.OperationalError:
+                pass  # Column already present
             await db.commit()
-        print(f"SQLiteContextStorage initialized at {self.db_path}")
+        logger.info("SQLiteContextStorage initialized at %s", self.db_path)
+
+    @staticmethod
+    async def _migrate_legacy_contexts(db):
+        """
+        Databases from before the split-table schema hold each context as a
+        single JSON blob in contexts(context_data). docker-compose persists
+        runtime/, so upgraded deployments hit this on first boot; rebuild
+        those rows into the contexts/messages layout so existing sessions
+        survive instead of every load raising OperationalError.
+        """
+        cursor = await db.execute("PRAGMA table_info(contexts)")
+        columns = {row[1] for row in await cursor.fetchall()}
+        await cursor.close()
+        if "context_data" not in columns:
+            return  # fresh database or already on the split schema
+
+        logger.info("Migrating legacy context blobs to the split schema...")
+        cursor = await db.execute("SELECT session_id, context_data FROM contexts")
+        legacy_rows = await cursor.fetchall()
+        await cursor.close()
+
+        await db.execute("ALTER TABLE contexts RENAME TO contexts_legacy")
+        await db.execute(CREATE_CONTEXTS_TABLE_SQL)
+        await db.execute(CREATE_MESSAGES_TABLE_SQL)
+
+        now = _now_ns()
+        migrated = 0
+        for session_id, blob in legacy_rows:
+            try:
+                data = _json_loads(blob)
+            except Exception as e:
+                logger.warning("Skipping unreadable legacy context %s: %s", session_id, e)
+                continue
+            await db.execute(
+                """INSERT OR REPLACE INTO contexts
+                   (session_id, ui_state, current_topic, learning_objectives,
+                    last_visualization_spec, last_render_output, rolling_summary, created_at, updated_at)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                (
+                    session_id,
+                    _json_dumps(data.get("ui_state") or {}),
+                    data.get("current_topic"),
+                    _json_dumps(data.get("learning_objectives") or []),
+                    _json_dumps(data["last_visualization_spec"]) if data.get("last_visualization_spec") else None,
+                    data.get("last_render_output"),
+                    data.get("rolling_summary"),
+                    now,
+                    now,
+                )
+            )
+            for seq, message in enumerate(data.get("messages") or []):
+                timestamp = message.get("timestamp")
+                if isinstance(timestamp, str):
+                    # Legacy messages carry ISO datetimes
+                    try:
+                        timestamp = int(datetime.fromisoformat(timestamp).timestamp() * 1e9)
+                    except ValueError:
+                        timestamp = now
+                await db.execute(
+                    "INSERT OR REPLACE INTO messages (session_id, seq, role, content, metadata, timestamp) VALUES (?, ?, ?, ?, ?, ?)",
+                    (
+                        session_id,
+                        seq,
+                        message.get("role", "user"),
+                        message.get("content", ""),
+                        _json_dumps(message["metadata"]) if message.get("metadata") else None,
+                        timestamp if isinstance(timestamp, int) else now,
+                    )
+                )
+            migrated += 1
+        await db.execute("DROP TABLE contexts_legacy")
+        await db.commit()
+        logger.info("Migrated %d legacy context(s) to the split schema.", migrated)
 
     async def save_context(self, context: LearningContext):
-        """Saves or updates a context in the database."""
-        context_json = context.model_dump_json() # Serialize Pydantic model to JSON string
+        """
+        Saves or updates a context in the database. The context row is always
+        upserted; messages are only inserted for the tail of the history that
+        is not yet persisted (messages are never mutated once written).
+        """
         session_id = context.session_id
-        now = datetime.now().isoformat()
+        now = _now_ns()
+
+        async with self.pool.connection() as db:
+            # Use INSERT OR REPLACE for upsert functionality on the context row
+            await db.execute(
+                """INSERT OR REPLACE INTO contexts
+                   (session_id, ui_state, current_topic, learning_objectives,
+                    last_visualization_spec, last_render_output, rolling_summary, created_at, updated_at)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                (
+                    session_id,
+                    _json_dumps(context.ui_state.model_dump(mode="json")),
+                    context.current_topic,
+                    _json_dumps(context.learning_objectives),
+                    _json_dumps(context.last_visualization_spec.model_dump(mode="json")) if context.last_visualization_spec else None,
+                    context.last_render_output,
+                    context.rolling_summary,
+                    now,
+                    now,
+                )
+            )
+
+            # Append only the messages not yet stored for this session. The
+            # split point comes from the context's own persisted counter (not
+            # a row count) so it stays correct when the history was loaded
+            # truncated; sequence numbers continue from the stored maximum.
+            new_messages = context.messages[context._persisted_messages:]
+            if new_messages:
+                cursor = await db.execute(
+                    "SELECT COALESCE(MAX(seq) + 1, 0) FROM messages WHERE session_id = ?",
+                    (session_id,)
+                )
+                row = await cursor.fetchone()
+                await cursor.close()
+                next_seq = row[0] if row else 0
+
+                for offset, message in enumerate(new_messages):
+                    await db.execute(
+                        "INSERT OR REPLACE INTO messages (session_id, seq, role, content, metadata, timestamp) VALUES (?, ?, ?, ?, ?, ?)",
+                        (
+                            session_id,
+                            next_seq + offset,
+                            message.role,
+                            message.content,
+                            _json_dumps(message.metadata) if message.metadata is not None else None,
+                            message.timestamp,
+                        )
+                    )
+            await db.commit()
+        context._persisted_messages = len(context.messages)
+        logger.debug("Context saved for session: %s", session_id)
 
-        async with aiosqlite.connect(self.db_path) as db:
-            # Use INSERT OR REPLACE for upsert functionality
+    async def append_message(self, session_id: str, message: ContextMessage):
+        """
+        Appends a single message for a session without touching the context
+        row or re-serializing the history. This is the O(1) fast path used
+        when only the message list changed.
+        """
+        async with self.pool.connection() as db:
             await db.execute(
-                "INSERT OR REPLACE INTO contexts (session_id, context_data, created_at, updated_at) VALUES (?, ?, ?, ?)",
-                (session_id, context_json, context.created_at.isoformat() if hasattr(context, 'created_at') else now, now)
+                """INSERT INTO messages (session_id, seq, role, content, metadata, timestamp)
+                   SELECT ?, COALESCE(MAX(seq) + 1, 0), ?, ?, ?, ?
+                   FROM messages WHERE session_id = ?""",
+                (
+                    session_id,
+                    message.role,
+                    message.content,
+                    _json_dumps(message.metadata) if message.metadata is not None else None,
+                    message.timestamp,
+                    session_id,
+                )
             )
             await db.commit()
-        print(f"Context saved for session: {session_id}") 
 
     async def load_context(self, session_id: str) -> Optional[LearningContext]:
-        """Loads a context from the database."""
-        async with aiosqlite.connect(self.db_path) as db:
-            cursor = await db.execute("SELECT context_data FROM contexts WHERE session_id = ?", (session_id,))
+        """Loads a context from the database, reassembling the message history."""
+        async with self.pool.connection() as db:
+            cursor = await db.execute(
+                """SELECT ui_state, current_topic, learning_objectives,
+                          last_visualization_spec, last_render_output, rolling_summary
+                   FROM contexts WHERE session_id = ?""",
+                (session_id,)
+            )
             row = await cursor.fetchone()
             await cursor.close()
 
-        if row:
-            context_json = row[0]
-            try:
-                # Deserialize JSON string back to Pydantic model
-                context = LearningContext.model_validate_json(context_json)
-                print(f"Context loaded for session: {session_id}") # verbose logging
-                return context
-            except Exception as e:
-                print(f"Error loading or validating context for session {session_id}: {e}")
-                # Handle corrupted data - maybe return None or a default context
+            if row is None:
+                logger.debug("No context found for session: %s", session_id)
                 return None
-        else:
-            print(f"No context found for session: {session_id}") 
+
+            # Newest rows first so LIMIT bounds the work, then restored to
+            # chronological order below.
+            cursor = await db.execute(
+                "SELECT role, content, metadata, timestamp FROM messages WHERE session_id = ? ORDER BY seq DESC LIMIT ?",
+                (session_id, MAX_LOADED_MESSAGES)
+            )
+            message_rows = await cursor.fetchall()
+            await cursor.close()
+            message_rows = message_rows[::-1]
+
+        try:
+            messages = [
+                ContextMessage(
+                    role=m_role,
+                    content=m_content,
+                    metadata=_json_loads(m_metadata) if m_metadata else None,
+                    # Rows written before the INTEGER switch hold ISO strings
+                    timestamp=m_timestamp if isinstance(m_timestamp, int)
+                    else int(datetime.fromisoformat(m_timestamp).timestamp() * 1e9),
+                )
+                for m_role, m_content, m_metadata, m_timestamp in message_rows
+            ]
+            context = LearningContext(
+                session_id=session_id,
+                messages=messages,
+                ui_state=UIState.model_validate(_json_loads(row[0])),
+                current_topic=row[1],
+                learning_objectives=_json_loads(row[2]),
+                last_visualization_spec=VisualizationSpec.model_validate(_json_loads(row[3])) if row[3] else None,
+                last_render_output=row[4],
+                rolling_summary=row[5],
+            )
+            context._persisted_messages = len(messages)
+            logger.debug("Context loaded for session: %s", session_id)
+            return context
+        except Exception as e:
+            logger.error("Error loading or validating context for session %s: %s", session_id, e)
+            # Handle corrupted data - maybe return None or a default context
             return None
 
     async def delete_context(self, session_id: str):
-        """Deletes a context from the database."""
-        async with aiosqlite.connect(self.db_path) as db:
+        """Deletes a context and its messages from the database."""
+        async with self.pool.connection() as db:
             await db.execute("DELETE FROM contexts WHERE session_id = ?", (session_id,))
+            await db.execute("DELETE FROM messages WHERE session_id = ?", (session_id,))
             await db.commit()
-        print(f"Context deleted for session: {session_id}")
-
+        logger.debug("Context deleted for session: %s", session_id)
 
-    # Important: For a long-running application, managing the connection pool
-    # for aiosqlite might be necessary instead of opening/closing per operation.
-    # For simplicity here, we use the context manager which handles per-operation.
 
 # This ensures the table exists before any operations.
 async def initialize_context_storage():
@@ -1,7 +1,9 @@
-import asyncio 
+import asyncio
+from collections import defaultdict
+from cachetools import LRUCache, TTLCache
 from typing import Dict, Any, Optional, Union
 from  backend.app.api.context.memory import SQLiteContextStorage, initialize_context_storage
-from backend.app.models.context import LearningContext, ContextMessage, UIState, VisualizationSpec, create_session_id
+from backend.app.models.context import LearningContext, ContextMessage, UIState, VisualizationSpec, create_session_id, MAX_HISTORY_MESSAGES
 from datetime import datetime
 
 class ContextProtocol:
@@ -20,6 +22,9 @@ class ContextProtocol:
         if storage_backend == "sqlite":
             self._storage = SQLiteContextStorage()
             self._storage_backend_name = "sqlite"
+            # Expose the shared connection pool so callers can reuse it
+            # (all storage operations draw connections from this pool).
+            self.pool = self._storage.pool
         else:
             # Fallback to a simple in-memory dictionary if no valid backend specified
             print(f"Warning: Unknown or unsupported storage backend '{storage_backend}'. Using in-memory.")
@@ -28,17 +33,13 @@ class ContextProtocol:
                  def __init__(self):
                      self._contexts: Dict[str, LearningContext] = {}
                  async def load_context(self, session_id: str) -> Optional[LearningContext]:
-                     # Simulate async I/O delay
-                     await asyncio.sleep(0.001)
                      return self._contexts.get(session_id)
                  async def save_context(self, context: LearningContext):
-                     # Simulate async I/O delay
-                     await asyncio.sleep(0.001)
-                     # Create a copy to avoid issues if the original object is modified elsewhere
-                     self._contexts[context.session_id] = context.model_copy(deep=True)
+                     # Store the instance directly: update_context already
+                     # produces fresh instances via model_copy(update=...),
+                     # so a deep copy of the whole history is not needed.
+                     self._contexts[context.session_id] = context
                  async def delete_context(self, session_id: str):
-                     # Simulate async I/O delay
-                     await asyncio.sleep(0.001)
                      self._contexts.pop(session_id, None)
                  # Add dummy init_db if storage requires it, or handle in protocol init
                  async def _init_db(self):
@@ -46,6 +47,31 @@ class ContextProtocol:
 
 
             self._storage = InMemoryStorage()
+            self.pool = None # No connection pool for the in-memory backend
+
+        # Per-session locks guard read-modify-write cycles (e.g. commit_turn)
+        # against lost updates when two requests for the same session overlap.
+        self._session_locks: Dict[str, asyncio.Lock] = defaultdict(asyncio.Lock)
+
+        # In-memory cache of live contexts. Each turn hits get_context several
+        # times for the same session; after warm-up those hits skip both the
+        # storage round trip and Pydantic re-validation of the whole history.
+        # Bounded by size *and* TTL so long-running processes shed idle
+        # sessions instead of accumulating them.
+        self._cache: TTLCache = TTLCache(maxsize=10_000, ttl=3600)
+
+        # Per-session LLM message lists, maintained incrementally. Rebuilding
+        # the provider-format list from context.messages is O(n) dict churn
+        # per turn; this cache appends one dict per new message instead.
+        self._llm_message_cache: LRUCache = LRUCache(maxsize=1024)
+
+        # Coalescing window for UI variable writes: slider scrubs emit tens
+        # of updates per second, and persisting each one amplifies the write
+        # load by the scrub rate. Pending values are merged per session and
+        # flushed once per window, latest value winning.
+        self._var_flush_window = 0.016  # seconds, ~one animation frame
+        self._pending_vars: Dict[str, Dict[str, Any]] = {}
+        self._var_flush_tasks: Dict[str, asyncio.Task] = {}
 
         print(f"ContextProtocol initialized using '{self._storage_backend_name}' storage backend.")
 
@@ -61,17 +87,29 @@ class ContextProtocol:
         Returns:
             The LearningContext object for the session.
         """
+        cached = self._cache.get(session_id)
+        if cached is not None:
+            return cached
+
+        # Serialize the miss path per session: without the lock, two
+        # concurrent first requests would both create-and-save the context
+        # and one turn's writes could land on a discarded instance.
+        async with self._session_locks[session_id]:
+            return await self._get_context_locked(session_id)
+
+    async def _get_context_locked(self, session_id: str) -> LearningContext:
+        """get_context body for callers already holding the session lock."""
+        cached = self._cache.get(session_id)
+        if cached is not None:
+            return cached
+
         context = await self._storage.load_context(session_id)
         if context is None:
             # If context not found in storage, create a new one
-            # Use the create_session_id default factory from the model if session_id is None,
-            # but typically get_context is called *with* a session_id provided by the UI/session management.
-            # Let's assume session_id is always provided here.
-            new_context = LearningContext(session_id=session_id)
-            await self._storage.save_context(new_context) # Save the newly created context
+            context = LearningContext(session_id=session_id)
+            await self._storage.save_context(context) # Save the newly created context
             print(f"Created and saved new context for session: {session_id}")
-            return new_context
-        # print(f"Retrieved context for session: {session_id}") # Optional: verbose logging
+        self._cache[session_id] = context
         return context
 
 
@@ -88,47 +126,112 @@ class ContextProtocol:
         Returns:
             The updated LearningContext object.
         """
-        context = await self.get_context(session_id) # Load existing context
+        # The whole read-modify-write runs under the session lock, like
+        # commit_turn: the chat endpoints call this concurrently with message
+        # persistence, and an unlocked load -> copy -> save would silently
+        # drop whichever write lands first.
+        async with self._session_locks[session_id]:
+            context = await self._get_context_locked(session_id) # Load existing context
 
-        # Apply updates using Pydantic's update capabilities for safety and structure
-        # A simple way is to dump to dict, apply updates, then validate back to Pydantic.
-        context_dict = context.model_dump() # Get dictionary representation
-
-        # Use a simple recursive update function or similar logic for nested dicts
-        # Pydantic v2's model_copy(update=...) is cleaner if applicable, but needs careful use.
-        # Let's use a deep merge for simplicity, but acknowledge Pydantic methods might be better.
-        def deep_update(source_dict, updates_dict):
-            for key, value in updates_dict.items():
-                if isinstance(value, dict) and key in source_dict and isinstance(source_dict[key], dict):
-                    # Recursively update if both are dictionaries
-                    source_dict[key] = deep_update(source_dict[key], value)
-                # elif isinstance(value, list) and key in source_dict and isinstance(source_dict[key], list):
-                #     # Decide how to handle lists: replace, extend, merge? Replace for now.
-                #     source_dict[key] = value
-                else:
-                    # Otherwise, set or overwrite the value
-                    source_dict[key] = value
-            return source_dict
-
-        updated_dict_data = deep_update(context_dict, updates)
-
-        # Create a new Pydantic instance from the updated dictionary data
-        # This handles validation and potential type casting from dict values
-        try:
-            updated_context = LearningContext(**updated_dict_data)
-            updated_context.updated_at = datetime.now() # Ensure updated_at is current
-        except Exception as e:
-             print(f"Error validating updated context data for session {session_id}: {e}")
-             # Depending on requirements, you might raise an error or return the original context
-             raise ValueError(f"Invalid update data provided: {e}") from e
+            # Apply updates with model_copy(update=...) instead of the old
+            # model_dump -> deep merge -> LearningContext(**dict) round trip.
+            # Reconstructing the model re-validated every ContextMessage in the
+            # history on each call; copying only touches the fields being updated.
+            try:
+                top_level_updates = dict(updates)
+                ui_state_updates = top_level_updates.pop("ui_state", None)
 
+                if isinstance(ui_state_updates, dict):
+                    ui_state_updates = dict(ui_state_updates)
+                    # Merge nested variable updates into the existing dict rather
+                    # than replacing it wholesale.
+                    variables = ui_state_updates.pop("variables", None)
+                    if isinstance(variables, dict):
+                        context.ui_state.variables.update(variables)
+                    new_ui_state = context.ui_state.model_copy(update=ui_state_updates)
+                    top_level_updates["ui_state"] = new_ui_state
 
-        # Save the updated context
-        await self._storage.save_context(updated_context)
-        # print(f"Context updated and saved for session: {session_id}") # Optional: verbose logging
-        return updated_context
+                updated_context = context.model_copy(update=top_level_updates)
+            except Exception as e:
+                 print(f"Error applying context updates for session {session_id}: {e}")
+                 # Depending on requirements, you might raise an error or return the original context
+                 raise ValueError(f"Invalid update data provided: {e}") from e
 
 
+            # Save the updated context and refresh the cache with the new instance
+            await self._storage.save_context(updated_context)
+            self._cache[session_id] = updated_context
+            # print(f"Context updated and saved for session: {session_id}") # Optional: verbose logging
+            return updated_context
+
+
+    async def get_llm_messages(self, session_id: str) -> list:
+        """
+        Returns the session's message history in the provider wire format
+        ([{'role': ..., 'content': ...}, ...]). The list is built once per
+        session and then extended incrementally by add_message/commit_turn,
+        so callers avoid rebuilding O(n) dicts on every LLM call. Callers
+        must not mutate the returned list.
+
+        Args:
+            session_id: The unique identifier for the session.
+
+        Returns:
+            The cached provider-format message list for the session.
+        """
+        cached = self._llm_message_cache.get(session_id)
+        if cached is None:
+            context = await self.get_context(session_id)
+            cached = [{"role": m.role, "content": m.content} for m in context.messages]
+            self._llm_message_cache[session_id] = cached
+        return cached
+
+    def _append_llm_message(self, session_id: str, role: str, content: str):
+        """Keeps the cached provider-format message list in sync on append."""
+        cached = self._llm_message_cache.get(session_id)
+        if cached is not None:
+            cached.append({"role": role, "content": content})
+            # Mirror the context's bounded history window
+            overflow = len(cached) - MAX_HISTORY_MESSAGES
+            if overflow > 0:
+                del cached[:overflow]
+
+    async def commit_turn(
+        self,
+        session_id: str,
+        user_message: str,
+        assistant_message: str,
+        spec: Optional[VisualizationSpec] = None,
+        render_output: Optional[str] = None,
+    ) -> LearningContext:
+        """
+        Persists a complete chat turn (user message, assistant reply and any
+        visualization result) with a single load and a single save, instead of
+        one full load/save round trip per individual mutation. Serializing the
+        growing message history once per turn rather than three times is the
+        main saving for long sessions.
+
+        Args:
+            session_id: The unique identifier for the session.
+            user_message: The user's message for this turn.
+            assistant_message: The assistant's reply for this turn.
+            spec: Optional VisualizationSpec produced during the turn.
+            render_output: Optional path/identifier of the rendered output.
+
+        Returns:
+            The updated LearningContext object.
+        """
+        async with self._session_locks[session_id]:
+            context = await self._get_context_locked(session_id) # Single load for the whole turn
+            context.add_message(role="user", content=user_message)
+            context.add_message(role="assistant", content=assistant_message)
+            self._append_llm_message(session_id, "user", user_message)
+            self._append_llm_message(session_id, "assistant", assistant_message)
+            if spec is not None:
+                context.set_visualization(spec, render_output)
+            await self._storage.save_context(context) # Single save for the whole turn
+        return context
+
     async def add_message(self, session_id: str, role: str, content: str, metadata: Optional[Dict[str, Any]] = None) -> LearningContext:
         """
         Adds a message to the context's message history and persists it.
@@ -144,7 +247,14 @@ class ContextProtocol:
         """
         context = await self.get_context(session_id) # Load existing context
         context.add_message(role=role, content=content, metadata=metadata) # Add message using Pydantic model method
-        await self._storage.save_context(context) # Save the modified context object
+        self._append_llm_message(session_id, role, content)
+        if hasattr(self._storage, "append_message"):
+            # Append-only fast path: insert just the new message row instead
+            # of re-serializing the whole context (O(1) instead of O(n)).
+            await self._storage.append_message(session_id, context.messages[-1])
+            context._persisted_messages = len(context.messages)
+        else:
+            await self._storage.save_context(context) # Save the modified context object
         # print(f"Message added and context saved for session: {session_id}") # Optional: verbose logging
         return context
 
@@ -161,10 +271,34 @@ class ContextProtocol:
         """
         context = await self.get_context(session_id) # Load existing context
         context.update_ui_variables(variables) # Update variables using Pydantic model method
-        await self._storage.save_context(context) # Save the modified context object
-        # print(f"UI variables updated and context saved for session: {session_id} -> {context.ui_state.variables}") # Optional: verbose logging
+
+        # The in-memory context is current immediately; persistence is
+        # coalesced so a burst of updates costs one save per flush window
+        # instead of one per event.
+        pending = self._pending_vars.setdefault(session_id, {})
+        pending.update(variables)
+        if session_id not in self._var_flush_tasks:
+            self._var_flush_tasks[session_id] = asyncio.create_task(
+                self._flush_ui_variables(session_id)
+            )
         return context
 
+    async def _flush_ui_variables(self, session_id: str):
+        """Persists coalesced UI variable updates after the flush window."""
+        try:
+            await asyncio.sleep(self._var_flush_window)
+        finally:
+            # Deregister before saving: updates arriving from here on must
+            # schedule a fresh flush rather than assume this one covers them.
+            self._var_flush_tasks.pop(session_id, None)
+        try:
+            self._pending_vars.pop(session_id, None)
+            async with self._session_locks[session_id]:
+                context = await self._get_context_locked(session_id)
+                await self._storage.save_context(context)
+        except Exception as e:
+            print(f"Failed to flush UI variables for session {session_id}: {e}")
+
     async def delete_context(self, session_id: str):
         """
         Deletes a context from storage.
@@ -172,6 +306,8 @@ class ContextProtocol:
         Args:
             session_id: The unique identifier for the session to delete.
         """
+        self._cache.pop(session_id, None) # Evict before deleting from storage
+        self._llm_message_cache.pop(session_id, None)
         await self._storage.delete_context(session_id)
         print(f"Context deleted for session: {session_id}")
 
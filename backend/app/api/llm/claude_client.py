@@ -1,76 +1,54 @@
+import asyncio
+import logging
 import os
 import json
-import re 
-from typing import Dict, Any, List, Union
+import re
+from typing import AsyncIterator, Dict, Any, List, Optional, Tuple, Union
 from .router import LLMProvider
 from backend.app.models.context import LearningContext, ContextMessage, VisualizationSpec
+from .prompts import STATIC_SYSTEM_PROMPT, build_session_state_block
+from .streaming import FencedJSONScanner, assemble_result
+from .http_client import get_http_client
 import anthropic
 
+logger = logging.getLogger(__name__)
+
+# Compiled once at import: matches the fenced JSON block in a response.
+# One search gives both the JSON payload (group 1) and, via span(), the
+# surrounding explanation text — no second DOTALL scan to strip the block.
+_JSON_BLOCK_RE = re.compile(r'```json\s*(.*?)\s*```', re.DOTALL)
+
+
 class ClaudeProvider(LLMProvider):
     def __init__(self):
         # API key loaded from environment
         api_key = os.getenv("ANTHROPIC_API_KEY")
         if not api_key:
              # Allow initialization even without key, but raise error on use
-             print("Warning: ANTHROPIC_API_KEY environment variable not set. ClaudeProvider will not work.")
+             logger.warning("ANTHROPIC_API_KEY environment variable not set. ClaudeProvider will not work.")
              self.client = None
         else:
-            self.client = anthropic.Anthropic(api_key=api_key)
+            # Async client on the shared httpx transport: calls here are
+            # awaited, and the shared pool keeps connections warm.
+            self.client = anthropic.AsyncAnthropic(api_key=api_key, http_client=get_http_client())
 
         # Define the LLM model to use
         # Choose a suitable Claude model, e.g., claude-3-opus-20240229, claude-3-sonnet-20240229, claude-3-haiku-20240307
         # Haiku is fastest/cheapest, Opus is strongest, Sonnet is a good balance.
-        self.model = os.getenv("ANTHROPIC_MODEL", "claude-4-haiku-20250507")  
+        self.model = os.getenv("ANTHROPIC_MODEL", "claude-4-haiku-20250507")
+        # Bound concurrent upstream requests here rather than letting uvicorn
+        # queue them at the socket level.
+        self._semaphore = asyncio.Semaphore(int(os.getenv("ANTHROPIC_MAX_IN_FLIGHT", "8")))
         if self.client:
-            print(f"ClaudeProvider initialized with model: {self.model}")
+            logger.info("ClaudeProvider initialized with model: %s", self.model)
 
 
-    async def generate_response(self, messages: List[Dict], context: LearningContext) -> Union[str, VisualizationSpec]:
+    def _format_messages(self, messages: List[Dict]) -> Optional[List[Dict]]:
         """
-        Generates a response using Anthropic Claude. Tries to generate a structured
-        VisualizationSpec if the user's prompt requests a visualization.
+        Formats message history for the Anthropic API, which expects
+        alternating 'user'/'assistant' roles ending with a user message.
+        Returns None if no usable messages can be produced.
         """
-        if not self.client:
-             return "Claude provider is not configured (ANTHROPIC_API_KEY not set)."
-
-        # Construct the system prompt - similar structure to OpenAI prompt
-        # emphasizing structured output and context awareness.
-        system_prompt = f"""
-You are an interactive educational assistant called 'VisualLearner'. Your primary goal is to help users understand concepts through explanations and dynamic visualizations.
-
-**Current State:**
-- Session ID: {context.session_id}
-- Current Topic: {context.current_topic if context.current_topic else 'Not specified'}
-- UI Variables: {json.dumps(context.ui_state.variables)}
-
-**Instructions:**
-1.  Always provide a clear, concise explanation of the concept or answer the user's question in standard markdown text first.
-2.  If the user asks to "visualize", "show a graph", "animate", "plot", "model", "simulate", etc., attempt to generate a structured visualization specification in JSON format. Place the JSON *after* your explanation, enclosed in ```json ... ``` block.
-3.  The JSON must conform to the `VisualizationSpec` structure:
-    ```json
-    {{
-      "type": "string", // Choose one: "plotly", "manim", "interactive_js", "text_explanation"
-      "explanation": "string", // Repeat or elaborate on the explanation text here
-      "content": {{ // Details specific to the type
-        // If type is "plotly": {{ "data": [{{...}}], "layout": {{...}} }} (standard Plotly figure dict)
-        // If type is "manim": {{ "scene_code": "string" }} (Python Manim code string)
-        // If type is "interactive_js": {{ "html": "string", "javascript": "string", "css": "string", "parameters": {{...}} }} (HTML for controls/canvas, JS logic, optional CSS, parameter specs for interactive controls)
-        // If type is "text_explanation": {{}} // Content is empty, only explanation is provided
-      }}
-    }}
-    ```
-4.  If a visualization is not appropriate or cannot be generated, provide only a text explanation and set the JSON `type` to `"text_explanation"` with empty content.
-5.  Use the `interactive_js` type for simple parameterized graphs (like sin(x+a), quadratic equations) that can be drawn on a 2D canvas with sliders.
-6.  Use the `plotly` type for static or more complex 2D/3D plots that Plotly supports.
-7.  Use the `manim` type for animations or more formal mathematical demonstrations.
-8.  Ensure the `explanation` field in the JSON matches the explanation provided outside the JSON block.
-9.  Always keep your responses helpful, educational, and friendly.
-"""
-
-        # Format messages for Anthropic API.
-        # Anthropic Messages API expects alternating 'user' and 'assistant' roles.
-        # The system prompt is a separate parameter.
-        # Ensure the last message is from the user.
         anthropic_messages = []
         for msg_dict in messages:
             # Basic validation/conversion for Anthropic roles
@@ -82,33 +60,67 @@ You are an interactive educational assistant called 'VisualLearner'. Your primar
 
         # Ensure the message list is not empty and ends with a user message
         if not anthropic_messages or anthropic_messages[-1]["role"] != "user":
-             print("Warning: Message history is not in expected format for Anthropic (empty or doesn't end with user).")
+             logger.warning("Message history is not in expected format for Anthropic (empty or doesn't end with user).")
              # Attempt to recover by just using the last user message if available
              last_user_message = next((m for m in reversed(messages) if m.get("role") == "user"), None)
              if last_user_message:
-                  anthropic_messages = [{"role": "user", "content": last_user_message["content"]}]
-             else:
-                 return "Could not format messages for the LLM."
+                  return [{"role": "user", "content": last_user_message["content"]}]
+             return None
+        return anthropic_messages
+
+    def _build_system_blocks(self, context: LearningContext) -> List[Dict]:
+        """
+        Static instructions first with a cache_control marker, session state
+        after. The static block is byte-identical on every call, so Anthropic
+        serves it from the prompt cache on warm sessions (discounted input
+        tokens, lower time-to-first-token); the small mutable state block
+        sits after the cache breakpoint and never invalidates it.
+        """
+        return [
+            {
+                "type": "text",
+                "text": STATIC_SYSTEM_PROMPT,
+                "cache_control": {"type": "ephemeral"},
+            },
+            {"type": "text", "text": build_session_state_block(context)},
+        ]
+
+    async def generate_response(self, messages: List[Dict], context: LearningContext) -> Union[str, VisualizationSpec]:
+        """
+        Generates a response using Anthropic Claude. Tries to generate a structured
+        VisualizationSpec if the user's prompt requests a visualization.
+        """
+        if not self.client:
+             return "Claude provider is not configured (ANTHROPIC_API_KEY not set)."
+
+        system_blocks = self._build_system_blocks(context)
+
+        anthropic_messages = self._format_messages(messages)
+        if anthropic_messages is None:
+            return "Could not format messages for the LLM."
 
 
         try:
-            print(f"Calling Claude model: {self.model}")
+            logger.debug("Calling Claude model: %s", self.model)
             # Use the async client method
-            response = await self.client.messages.create(
-                model=self.model,
-                system=system_prompt, # System prompt as a separate parameter
-                messages=anthropic_messages,
-                max_tokens=2500, # Allow enough tokens
-                temperature=0.7
-            )
+            async with self._semaphore:
+                response = await self.client.messages.create(
+                    model=self.model,
+                    system=system_blocks, # System prompt as content blocks (static prefix first)
+                    messages=anthropic_messages,
+                    max_tokens=2500, # Allow enough tokens
+                    temperature=0.7
+                )
 
             # The response content is a list of content blocks
             response_content = "".join(block.text for block in response.content if block.type == 'text')
-            print(f"Received Claude response (partial):\n{response_content[:500]}...")
+            if logger.isEnabledFor(logging.DEBUG):
+                # Guarded so the 500-char slice isn't built in production
+                logger.debug("Received Claude response (partial):\n%s...", response_content[:500])
 
 
-            # Attempt to parse JSON from the response using the same regex
-            json_match = re.search(r'```json\s*(.*?)\s*```', response_content, re.DOTALL)
+            # Attempt to parse JSON from the response with the precompiled pattern
+            json_match = _JSON_BLOCK_RE.search(response_content)
 
             if json_match:
                 json_string = json_match.group(1)
@@ -116,40 +128,155 @@ You are an interactive educational assistant called 'VisualLearner'. Your primar
                     spec_data = json.loads(json_string)
                     # Validate against Pydantic model
                     visualization_spec = VisualizationSpec(**spec_data)
-                    # You might want to clean the raw response content to remove the JSON block
-                    # before using it as the primary text explanation, or rely solely
-                    # on the explanation field within the JSON. Let's clean the raw text.
-                    text_explanation = re.sub(r'```json\s*.*?```', '', response_content, flags=re.DOTALL).strip()
+                    # Slice the JSON block out via the match span instead of a
+                    # second regex pass; the remaining prose is the explanation.
+                    text_explanation = (
+                        response_content[:json_match.start()] + response_content[json_match.end():]
+                    ).strip()
                     # Use the cleaned text explanation
                     visualization_spec.explanation = text_explanation
 
                     return visualization_spec
 
                 except json.JSONDecodeError as e:
-                    print(f"Warning: Claude returned invalid JSON: {e}\nContent: {json_string}")
+                    logger.warning("Claude returned invalid JSON: %s\nContent: %s", e, json_string)
                     # Fallback to returning just the text response if JSON is invalid
                     return response_content
                 except Exception as e:
-                    print(f"Warning: Failed to parse Claude JSON response into spec: {e}\nContent: {json_string}")
+                    logger.warning("Failed to parse Claude JSON response into spec: %s\nContent: %s", e, json_string)
                      # Fallback to returning just the text response if validation fails
                     return response_content
             else:
                 # No JSON block found, return plain text response
-                print("No JSON block found in Claude response, returning text.")
+                logger.debug("No JSON block found in Claude response, returning text.")
                 return response_content
 
         except anthropic.APIConnectionError as e:
-            print(f"Claude API connection error: {e}")
+            logger.error("Claude API connection error: %s", e)
             return f"An API connection error occurred with Claude: {e}"
         except anthropic.RateLimitError as e:
-             print(f"Claude Rate limit error: {e}")
+             logger.warning("Claude Rate limit error: %s", e)
              return "You've hit the rate limit for the Claude API. Please try again later."
         except anthropic.AuthenticationError as e:
-             print(f"Claude Authentication error: {e}")
+             logger.error("Claude Authentication error: %s", e)
              return "Authentication failed for the Claude API. Check your API key."
         except anthropic.APIStatusError as e:
-            print(f"Claude API status error {e.status_code}: {e.response}")
+            logger.error("Claude API status error %s: %s", e.status_code, e.response)
             return f"An API error occurred with Claude (Status {e.status_code})."
         except Exception as e:
-            print(f"An unexpected error occurred during Claude call: {e}")
-            return f"An unexpected error occurred: {e}"
\ No newline at end of file
+            logger.error("An unexpected error occurred during Claude call: %s", e)
+            return f"An unexpected error occurred: {e}"
+
+    def _parse_response_text(self, content: str) -> Union[str, VisualizationSpec]:
+        """Parses a complete response text into a spec or plain text."""
+        json_match = _JSON_BLOCK_RE.search(content)
+        if not json_match:
+            return content
+        explanation = (content[:json_match.start()] + content[json_match.end():]).strip()
+        return assemble_result(explanation, json_match.group(1))
+
+    async def generate_batch(
+        self, batch: List[Tuple[List[Dict], LearningContext]], poll_interval: float = 20.0
+    ) -> List[Union[str, VisualizationSpec]]:
+        """
+        Runs a list of (messages, context) requests through the Anthropic
+        Batches API. Batched requests are billed at half the interactive
+        rate, so offline workloads (precomputing specs, evaluation runs)
+        should use this instead of route_request. Results come back in
+        input order; failed entries become error strings.
+        """
+        if not self.client:
+            return ["Claude provider is not configured (ANTHROPIC_API_KEY not set)."] * len(batch)
+
+        requests = []
+        for index, (messages, context) in enumerate(batch):
+            custom_id = f"{context.session_id}:{index}"
+            anthropic_messages = self._format_messages(messages)
+            if anthropic_messages is None:
+                continue
+            requests.append({
+                "custom_id": custom_id,
+                "params": {
+                    "model": self.model,
+                    "system": self._build_system_blocks(context),
+                    "messages": anthropic_messages,
+                    "max_tokens": 2500,
+                    "temperature": 0.7,
+                },
+            })
+
+        results: Dict[str, Union[str, VisualizationSpec]] = {}
+        try:
+            message_batch = await self.client.messages.batches.create(requests=requests)
+            logger.info("Submitted Claude batch %s with %d requests.", message_batch.id, len(requests))
+            while message_batch.processing_status != "ended":
+                await asyncio.sleep(poll_interval)
+                message_batch = await self.client.messages.batches.retrieve(message_batch.id)
+
+            async for entry in await self.client.messages.batches.results(message_batch.id):
+                if entry.result.type == "succeeded":
+                    content = "".join(
+                        block.text for block in entry.result.message.content if block.type == "text"
+                    )
+                    results[entry.custom_id] = self._parse_response_text(content)
+                else:
+                    results[entry.custom_id] = f"Batch request failed ({entry.result.type})."
+        except Exception as e:
+            logger.error("Claude batch request failed: %s", e)
+            return [f"Batch request failed: {e}"] * len(batch)
+
+        return [
+            results.get(f"{context.session_id}:{index}", "Could not format messages for the LLM.")
+            for index, (_, context) in enumerate(batch)
+        ]
+
+    async def stream_response(self, messages: List[Dict], context: LearningContext) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Streams a response from Claude, yielding explanation text as
+        'text_delta' events as it arrives and a final 'result' event. The
+        fenced ```json block is carved out incrementally by FencedJSONScanner
+        instead of re-scanning the assembled reply with a regex.
+        """
+        if not self.client:
+            yield {"type": "result", "value": "Claude provider is not configured (ANTHROPIC_API_KEY not set)."}
+            return
+
+        system_blocks = self._build_system_blocks(context)
+        anthropic_messages = self._format_messages(messages)
+        if anthropic_messages is None:
+            yield {"type": "result", "value": "Could not format messages for the LLM."}
+            return
+
+        scanner = FencedJSONScanner()
+        explanation_parts: List[str] = []
+        try:
+            logger.debug("Streaming from Claude model: %s", self.model)
+            async with self._semaphore:
+                async with self.client.messages.stream(
+                    model=self.model,
+                    system=system_blocks,
+                    messages=anthropic_messages,
+                    max_tokens=2500,
+                    temperature=0.7
+                ) as stream:
+                    async for text in stream.text_stream:
+                        released = scanner.feed(text)
+                        if released:
+                            explanation_parts.append(released)
+                            yield {"type": "text_delta", "text": released}
+            tail = scanner.finalize()
+            if tail:
+                explanation_parts.append(tail)
+                yield {"type": "text_delta", "text": tail}
+
+            explanation_text = "".join(explanation_parts).strip()
+            yield {"type": "result", "value": assemble_result(explanation_text, scanner.json_text)}
+        except anthropic.APIConnectionError as e:
+            logger.error("Claude API connection error: %s", e)
+            yield {"type": "result", "value": f"An API connection error occurred with Claude: {e}"}
+        except anthropic.RateLimitError as e:
+            logger.warning("Claude Rate limit error: %s", e)
+            yield {"type": "result", "value": "You've hit the rate limit for the Claude API. Please try again later."}
+        except Exception as e:
+            logger.error("An unexpected error occurred during Claude stream: %s", e)
+            yield {"type": "result", "value": f"An unexpected error occurred: {e}"}
\ No newline at end of file
@@ -0,0 +1,37 @@
+"""
+Shared HTTP transport for the LLM providers.
+
+Both the OpenAI and Anthropic SDKs accept an explicit httpx.AsyncClient.
+Sharing one long-lived client gives every LLM call a warm, keep-alive
+connection pool (and HTTP/2 multiplexing) instead of paying a fresh
+TCP+TLS handshake whenever the SDK's default transport evicts an idle
+connection — a round-trip that dominates latency on short responses.
+"""
+import httpx
+
+# Created lazily so importing this module stays cheap and so the client is
+# bound to the event loop that first uses it.
+_http_client = None
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """Returns the shared AsyncClient, creating it on first use."""
+    global _http_client
+    if _http_client is None:
+        _http_client = httpx.AsyncClient(
+            http2=True,
+            limits=httpx.Limits(
+                max_keepalive_connections=32,
+                max_connections=64,
+                keepalive_expiry=60.0,
+            ),
+        )
+    return _http_client
+
+
+async def aclose_http_client() -> None:
+    """Closes the shared client; call from the FastAPI shutdown event."""
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
@@ -1,101 +1,197 @@
+import asyncio
+import logging
 import os
-from typing import Dict, Any, List, Union
+from typing import AsyncIterator, Dict, Any, List, Tuple, Union
 from .router import LLMProvider
 from backend.app.models.context import LearningContext, ContextMessage, VisualizationSpec
+from .prompts import STATIC_SYSTEM_PROMPT, build_session_state_block
+from .streaming import FencedJSONScanner, assemble_result
+from .http_client import get_http_client
+from backend.app.core.fastjson import json_dumps, json_loads
 import openai
+from pydantic import ValidationError
 import json
 import re # To extract JSON from text
 
+logger = logging.getLogger(__name__)
+
+# Compiled once at import; one search finds the fenced JSON block without
+# re-scanning the response.
+_JSON_BLOCK_RE = re.compile(r'```json\s*(.*?)\s*```', re.DOTALL)
+
+
 class OpenAIProvider(LLMProvider):
     def __init__(self):
         # API key loaded from environment
         api_key = os.getenv("OPENAI_API_KEY")
         if not api_key:
              raise ValueError("OPENAI_API_KEY environment variable not set.")
-        self.client = openai.OpenAI(api_key=api_key)
+        # Async client on the shared httpx transport: calls here are awaited,
+        # and the shared pool keeps connections warm across requests.
+        self.client = openai.AsyncOpenAI(api_key=api_key, http_client=get_http_client())
         # Define the LLM model to use
         self.model = os.getenv("OPENAI_MODEL", "gpt-4o-mini") # Use a capable model for JSON
-        print(f"OpenAIProvider initialized with model: {self.model}")
+        # Bound concurrent upstream requests here rather than letting uvicorn
+        # queue them at the socket level.
+        self._semaphore = asyncio.Semaphore(int(os.getenv("OPENAI_MAX_IN_FLIGHT", "8")))
+        logger.info("OpenAIProvider initialized with model: %s", self.model)
 
     async def generate_response(self, messages: List[Dict], context: LearningContext) -> Union[str, VisualizationSpec]:
         """
         Generates a response. Tries to generate a structured VisualizationSpec
         if the user's prompt requests a visualization.
         """
-        # Create enhanced system prompt with context and instruction for structured output
-        system_prompt = f"""
-You are an interactive educational assistant called 'VisualLearner'. Your primary goal is to help users understand concepts through explanations and dynamic visualizations.
-
-**Current State:**
-- Session ID: {context.session_id}
-- Current Topic: {context.current_topic if context.current_topic else 'Not specified'}
-- UI Variables: {json.dumps(context.ui_state.variables)}
-
-**Instructions:**
-1.  Always provide a clear, concise explanation of the concept or answer the user's question in standard markdown text first.
-2.  If the user asks to "visualize", "show a graph", "animate", "plot", "model", "simulate", etc., attempt to generate a structured visualization specification in JSON format. Place the JSON *after* your explanation, enclosed in ```json ... ``` block.
-3.  The JSON must conform to the `VisualizationSpec` structure:
-    ```json
-    {{
-      "type": "string", // Choose one: "plotly", "manim", "interactive_js", "text_explanation"
-      "explanation": "string", // Repeat or elaborate on the explanation text here
-      "content": {{ // Details specific to the type
-        // If type is "plotly": {{ "data": [{{...}}], "layout": {{...}} }} (standard Plotly figure dict)
-        // If type is "manim": {{ "scene_code": "string" }} (Python Manim code string)
-        // If type is "interactive_js": {{ "html": "string", "javascript": "string", "css": "string", "parameters": {{...}} }} (HTML for controls/canvas, JS logic, optional CSS, parameter specs for interactive controls)
-        // If type is "text_explanation": {{}} // Content is empty, only explanation is provided
-      }}
-    }}
-
-    ```
-4.  If a visualization is not appropriate or cannot be generated, provide only a text explanation and set the JSON `type` to `"text_explanation"` with empty content.
-5.  Use the `interactive_js` type for simple parameterized graphs (like sin(x+a), quadratic equations) that can be drawn on a 2D canvas with sliders.
-6.  Use the `plotly` type for static or more complex 2D/3D plots that Plotly supports.
-7.  Use the `manim` type for animations or more formal mathematical demonstrations.
-8.  Ensure the `explanation` field in the JSON matches the explanation provided outside the JSON block.
-9.  Always keep your responses helpful, educational, and friendly.
-
-**Example JSON Structure for sin(x+a) Interactive JS:**
-```json
-{{
-  "type": "interactive_js",
-  "explanation": "Let's visualize the sine wave $y = \sin(x+a)$ where $a$ is the phase shift.",
-  "content": {{
-    "function_expr": "Math.sin(x + a)",
-    "parameters": {{
-      "a": {{"min": 0, "max": 6.28, "default": 0, "step": 0.1, "label": "Phase Shift (a)"}}
-    }}
-  }}
-}}```
-        """
-        
-        # Prepare the messages for the OpenAI API
-        openai_messages = [
-            {"role": "system", "content": system_prompt},
-            *messages  # Include user and assistant messages
+        # Prepare the messages for the OpenAI API. The static system prompt is
+        # byte-identical across turns and the history is append-only, so this
+        # prefix stays stable for OpenAI's prompt cache. The per-session
+        # mutable state goes in a trailing system message, after the cached
+        # portion.
+        openai_messages = self._build_messages(messages, context)
+
+        try:
+            async with self._semaphore:
+                response = await self.client.chat.completions.create(
+                    model=self.model,
+                    messages=openai_messages,
+                    max_tokens=1500,  # Adjust as needed
+                    temperature=0.7,  # Adjust for creativity vs. accuracy
+                )
+        except openai.APIError as e:
+            # Only provider errors are swallowed into a user-visible string;
+            # cancellations and programming errors propagate.
+            logger.error("Error generating response: %s", e)
+            return str(e)
+
+        # Extract the content from the response
+        content = response.choices[0].message.content.strip()
+
+        # Try to extract JSON from the response with the precompiled pattern
+        json_match = _JSON_BLOCK_RE.search(content)
+        if json_match:
+            json_content = json_match.group(1).strip()
+            try:
+                return VisualizationSpec.model_validate_json(json_content)
+            except ValidationError as e:
+                # A malformed spec degrades to the plain-text reply instead
+                # of turning the whole turn into an error string.
+                logger.warning("Discarding invalid VisualizationSpec: %s", e)
+
+        # If no JSON found, return the plain text response
+        return content
+
+    def _build_messages(self, messages: List[Dict], context: LearningContext) -> List[Dict]:
+        """Static system prompt, history, then the mutable session state."""
+        return [
+            {"role": "system", "content": STATIC_SYSTEM_PROMPT},
+            *messages,
+            {"role": "system", "content": build_session_state_block(context)},
         ]
 
+    def _parse_response_text(self, content: str) -> Union[str, VisualizationSpec]:
+        """Parses a complete response text into a spec or plain text."""
+        json_match = _JSON_BLOCK_RE.search(content)
+        if not json_match:
+            return content
+        explanation = (content[:json_match.start()] + content[json_match.end():]).strip()
+        return assemble_result(explanation, json_match.group(1))
+
+    async def generate_batch(
+        self, batch: List[Tuple[List[Dict], LearningContext]], poll_interval: float = 20.0
+    ) -> List[Union[str, VisualizationSpec]]:
+        """
+        Runs a list of (messages, context) requests through the OpenAI
+        Batch API (half-price vs the interactive endpoint). Intended for
+        offline workloads; results come back in input order with failed
+        entries replaced by error strings.
+        """
+        lines = []
+        custom_ids = []
+        for index, (messages, context) in enumerate(batch):
+            custom_id = f"{context.session_id}:{index}"
+            custom_ids.append(custom_id)
+            lines.append(json_dumps({
+                "custom_id": custom_id,
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": {
+                    "model": self.model,
+                    "messages": self._build_messages(messages, context),
+                    "max_tokens": 1500,
+                    "temperature": 0.7,
+                },
+            }))
+
+        results: Dict[str, Union[str, VisualizationSpec]] = {}
         try:
-            response = await self.client.chat.completions.create(
-                model=self.model,
-                messages=openai_messages,
-                max_tokens=1500,  # Adjust as needed
-                temperature=0.7,  # Adjust for creativity vs. accuracy
+            batch_file = await self.client.files.create(
+                file=("batch.jsonl", "\n".join(lines).encode("utf-8")),
+                purpose="batch",
             )
-            
-            # Extract the content from the response
-            content = response.choices[0].message.content.strip()
-            
-            # Try to extract JSON from the response using regex
-            json_match = re.search(r'```json\s*(.*?)\s*```', content, re.DOTALL)
-            if json_match:
-                json_content = json_match.group(1).strip()
-                visualization_spec = VisualizationSpec.model_validate_json(json_content)
-                return visualization_spec
-            
-            # If no JSON found, return the plain text response
-            return content
-        
+            job = await self.client.batches.create(
+                input_file_id=batch_file.id,
+                endpoint="/v1/chat/completions",
+                completion_window="24h",
+            )
+            logger.info("Submitted OpenAI batch %s with %d requests.", job.id, len(lines))
+            while job.status not in ("completed", "failed", "expired", "cancelled"):
+                await asyncio.sleep(poll_interval)
+                job = await self.client.batches.retrieve(job.id)
+
+            if job.status != "completed" or not job.output_file_id:
+                return [f"Batch job ended with status '{job.status}'."] * len(batch)
+
+            output = await self.client.files.content(job.output_file_id)
+            for line in output.text.splitlines():
+                if not line.strip():
+                    continue
+                entry = json_loads(line)
+                response_body = (entry.get("response") or {}).get("body") or {}
+                choices = response_body.get("choices") or []
+                if choices:
+                    content = (choices[0].get("message") or {}).get("content", "")
+                    results[entry["custom_id"]] = self._parse_response_text(content.strip())
+                else:
+                    results[entry["custom_id"]] = "Batch request returned no choices."
+        except Exception as e:
+            logger.error("OpenAI batch request failed: %s", e)
+            return [f"Batch request failed: {e}"] * len(batch)
+
+        return [results.get(custom_id, "No result returned for batch request.") for custom_id in custom_ids]
+
+    async def stream_response(self, messages: List[Dict], context: LearningContext) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Streams a response, yielding explanation text as 'text_delta' events
+        the moment chunks arrive and a final 'result' event. The fenced JSON
+        block (if any) is split out incrementally by FencedJSONScanner, so
+        there is no post-hoc regex scan of the full reply.
+        """
+        openai_messages = self._build_messages(messages, context)
+
+        scanner = FencedJSONScanner()
+        explanation_parts: List[str] = []
+        try:
+            async with self._semaphore:
+                stream = await self.client.chat.completions.create(
+                    model=self.model,
+                    messages=openai_messages,
+                    max_tokens=1500,
+                    temperature=0.7,
+                    stream=True,
+                )
+                async for chunk in stream:
+                    delta = chunk.choices[0].delta.content if chunk.choices else None
+                    if delta:
+                        text = scanner.feed(delta)
+                        if text:
+                            explanation_parts.append(text)
+                            yield {"type": "text_delta", "text": text}
+            tail = scanner.finalize()
+            if tail:
+                explanation_parts.append(tail)
+                yield {"type": "text_delta", "text": tail}
+
+            explanation_text = "".join(explanation_parts).strip()
+            yield {"type": "result", "value": assemble_result(explanation_text, scanner.json_text)}
         except Exception as e:
-            print(f"Error generating response: {e}")
-            return str(e)
\ No newline at end of file
+            logger.error("Error streaming response: %s", e)
+            yield {"type": "result", "value": str(e)}
\ No newline at end of file
@@ -1,9 +1,54 @@
+import asyncio
+import hashlib
+import logging
 from abc import ABC, abstractmethod
-from typing import Dict, Any, List, Union
-import os 
+from typing import AsyncIterator, Dict, Any, List, Optional, Tuple, Union
+import os
+from cachetools import TTLCache
+from backend.app.core.fastjson import json_dumps
 from backend.app.models.context import LearningContext, VisualizationSpec
-from .openai_client import OpenAIProvider
-from .claude_client import ClaudeProvider
+from .prompts import build_session_state_block
+from .structural_cache import StructuralSpecCache
+
+logger = logging.getLogger(__name__)
+
+# Plain-string failure replies produced by the providers' error handlers,
+# matched by prefix. The speculative race must not let an instantly-failing
+# provider beat a healthy one that is still in flight.
+_PROVIDER_ERROR_PREFIXES = (
+    "Claude provider is not configured",
+    "An API connection error occurred",
+    "You've hit the rate limit",
+    "Authentication failed for the Claude API",
+    "An API error occurred with Claude",
+    "An unexpected error occurred",
+    "Error code:",          # str(openai.APIError)
+    "Connection error",     # str(openai.APIConnectionError)
+)
+
+
+def _is_provider_error_string(value: str) -> bool:
+    """True when a provider returned its error-reply string, not an answer."""
+    return value.startswith(_PROVIDER_ERROR_PREFIXES)
+
+
+def _consume_task_exception(task: "asyncio.Task") -> None:
+    """Retrieves a finished racer's exception so the loop never warns."""
+    if not task.cancelled():
+        task.exception()
+
+
+# Provider factories import their SDK on first use, so a process (or warm
+# serverless container) that only ever talks to one provider never pays the
+# other SDK's import time.
+def _make_claude() -> "LLMProvider":
+    from .claude_client import ClaudeProvider
+    return ClaudeProvider()
+
+
+def _make_openai() -> "LLMProvider":
+    from .openai_client import OpenAIProvider
+    return OpenAIProvider()
 
 
 class LLMProvider(ABC):
@@ -18,30 +63,63 @@ class LLMProvider(ABC):
         """
         pass
 
+    @abstractmethod
+    def stream_response(self, messages: List[Dict], context: LearningContext) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Streaming variant of generate_response. Yields event dicts:
+        {'type': 'text_delta', 'text': ...} for explanation text as it
+        arrives, followed by a final {'type': 'result', 'value': ...} whose
+        value matches what generate_response would have returned.
+        """
+        pass
+
+    @abstractmethod
+    async def generate_batch(
+        self, batch: List[Tuple[List[Dict], LearningContext]], poll_interval: float = 20.0
+    ) -> List[Union[str, VisualizationSpec]]:
+        """
+        Runs many requests through the provider's discounted Batch API.
+        Returns results in input order; failures become error strings.
+        Intended for offline/bulk workloads, not the interactive path.
+        """
+        pass
+
 
 class LLMRouter:
     """Routes LLM requests to the appropriate provider."""
 
     def __init__(self):
-        """Initializes available LLM providers."""
+        """Registers available LLM provider factories."""
         self.providers: Dict[str, LLMProvider] = {}
 
-        # Initialize providers based on availability/config
-        # Providers should handle their own API key checking
-        try:
-            self.providers["claude"] = ClaudeProvider()
-            print("Initialized ClaudeProvider.")
-        except ValueError as e:
-             print(f"ClaudeProvider not initialized: {e}")
+        # Providers are constructed (and their SDKs imported) lazily on the
+        # first request that needs them. Providers handle their own API key
+        # checking; a failed factory is dropped so it isn't retried per call.
+        self._provider_factories = {
+            "claude": _make_claude,
+            "openai": _make_openai,
+        }
 
-        try:
-            self.providers["openai"] = OpenAIProvider()
-            print("Initialized OpenAIProvider.")
-        except ValueError as e:
-            print(f"OpenAIProvider not initialized: {e}")
+        # Structural cache: repeat-shaped visualization requests that differ
+        # only in literals are answered from a cached spec template without
+        # an LLM round-trip.
+        self._structural_cache = StructuralSpecCache()
+
+        # Exact-match response cache, content-addressed by a hash of the
+        # provider, message sequence and session state block. Identical
+        # prompts recur across sessions (same course content, same
+        # defaults); a hit skips the provider round-trip entirely.
+        self._response_cache: TTLCache = TTLCache(maxsize=2048, ttl=86400)
 
-        if not self.providers:
-            print("Warning: No LLM providers were successfully initialized!")
+    @staticmethod
+    def _request_key(provider_name: str, messages: List[Dict], context: LearningContext) -> str:
+        """Content hash identifying one complete provider request."""
+        blob = "\0".join((
+            provider_name,
+            json_dumps(messages),
+            build_session_state_block(context),
+        ))
+        return hashlib.sha256(blob.encode("utf-8")).hexdigest()
 
 
     async def route_request(self, provider_name: str, messages: List[Dict], context: LearningContext) -> Union[str, VisualizationSpec]:
@@ -61,16 +139,185 @@ class LLMRouter:
             ValueError: If the requested provider is not available.
             Exception: Propagates exceptions from the LLM provider's generate_response method.
         """
-        provider = self.providers.get(provider_name.lower())
-        if not provider:
-            # Fallback if the requested provider isn't available but others are
-            if self.providers:
-                 default_provider_name = list(self.providers.keys())[0]
-                 print(f"Warning: Provider '{provider_name}' not found. Using default: '{default_provider_name}'.")
-                 provider = self.providers[default_provider_name]
-            else:
-                raise ValueError(f"No LLM providers are available. Cannot route request for '{provider_name}'.")
+        provider = self._resolve_provider(provider_name)
+
+        last_user_message = next(
+            (m.get("content") for m in reversed(messages) if m.get("role") == "user"), None
+        )
+        if last_user_message:
+            cached_spec = self._structural_cache.lookup(last_user_message, context)
+            if cached_spec is not None:
+                logger.debug("Structural cache hit — skipping LLM call.")
+                return cached_spec
+
+        # Exact-prompt cache: same provider, messages and session state
+        # produce the same answer for a day.
+        request_key = self._request_key(provider_name, messages, context)
+        cached_result = self._response_cache.get(request_key)
+        if cached_result is not None:
+            logger.debug("Exact response cache hit — skipping LLM call.")
+            return cached_result
 
         # Call the single generate_response method
-        return await provider.generate_response(messages=messages, context=context)
+        result = await provider.generate_response(messages=messages, context=context)
+
+        # Only specs are cached: providers surface failures as plain strings
+        # (rate limits, connection errors), and a plain-text reply is
+        # indistinguishable from one — replaying a transient failure as the
+        # canonical answer for a day is worse than re-asking.
+        if isinstance(result, VisualizationSpec):
+            self._response_cache[request_key] = result
+            if last_user_message:
+                self._structural_cache.store(last_user_message, context, result)
+        return result
+
+    async def stream_request(self, provider_name: str, messages: List[Dict], context: LearningContext) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Streaming counterpart of route_request. Yields the provider's event
+        dicts ('text_delta' events followed by a final 'result' event) so
+        callers can surface text as it arrives instead of waiting for the
+        full response.
+
+        Raises:
+            ValueError: If no LLM provider is available.
+        """
+        provider = self._resolve_provider(provider_name)
+        async for event in provider.stream_response(messages=messages, context=context):
+            yield event
+
+    async def route_speculative(
+        self, messages: List[Dict], context: LearningContext
+    ) -> Union[str, VisualizationSpec]:
+        """
+        Races all available providers and returns the first finished
+        response, cancelling the rest. End-to-end latency becomes the
+        minimum across providers instead of one provider's tail — at the
+        cost of paying for the losing calls, so callers should opt in only
+        for latency-critical turns.
+
+        Raises:
+            ValueError: If no LLM provider is available.
+        """
+        providers = self._ensure_all_providers()
+        # Providers that constructed without a usable client (e.g. Claude
+        # with no API key) answer instantly with a misconfiguration string;
+        # racing them would always "win" and cancel the real provider.
+        racers = {
+            name: provider
+            for name, provider in providers.items()
+            if getattr(provider, "client", True) is not None
+        }
+        if not racers:
+            raise ValueError("No LLM providers are available. Cannot route speculative request.")
+        if len(racers) == 1:
+            # Nothing to race
+            provider = next(iter(racers.values()))
+            return await provider.generate_response(messages=messages, context=context)
+
+        last_user_message = next(
+            (m.get("content") for m in reversed(messages) if m.get("role") == "user"), None
+        )
+        if last_user_message:
+            cached_spec = self._structural_cache.lookup(last_user_message, context)
+            if cached_spec is not None:
+                logger.debug("Structural cache hit — skipping speculative LLM race.")
+                return cached_spec
+
+        tasks = {
+            asyncio.create_task(provider.generate_response(messages=messages, context=context)): name
+            for name, provider in racers.items()
+        }
+        for task in tasks:
+            task.add_done_callback(_consume_task_exception)
+
+        # A degraded provider turns its failure into a plain string in
+        # milliseconds — exactly the case racing is meant to hedge — so
+        # error-shaped strings only count as the answer once every other
+        # racer has also failed.
+        result = None
+        error_fallback: Optional[str] = None
+        remaining = set(tasks)
+        try:
+            while remaining and result is None:
+                done, remaining = await asyncio.wait(remaining, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    name = tasks[task]
+                    try:
+                        value = task.result()
+                    except Exception as e:
+                        logger.warning("Speculative racer '%s' failed: %s", name, e)
+                        continue
+                    if isinstance(value, str) and _is_provider_error_string(value):
+                        logger.warning("Speculative racer '%s' returned an error reply.", name)
+                        if error_fallback is None:
+                            error_fallback = value
+                        continue
+                    logger.debug("Speculative race won by provider '%s'.", name)
+                    result = value
+                    break
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+        if result is None:
+            # Every racer failed; surface the first error reply the way a
+            # direct provider call would have.
+            if error_fallback is not None:
+                return error_fallback
+            raise Exception("All providers failed during the speculative race.")
+
+        if last_user_message and isinstance(result, VisualizationSpec):
+            self._structural_cache.store(last_user_message, context, result)
+        return result
+
+    async def route_batch(
+        self,
+        provider_name: str,
+        batch: List[Tuple[List[Dict], LearningContext]],
+    ) -> List[Union[str, VisualizationSpec]]:
+        """
+        Routes a list of (messages, context) pairs through the provider's
+        Batch API. Batched traffic is billed at roughly half the interactive
+        rate, so precompute/evaluation jobs should go through here; latency
+        is minutes-to-hours, so never use it for a live chat turn.
+        """
+        provider = self._resolve_provider(provider_name)
+        return await provider.generate_batch(batch)
+
+    def _get_or_create_provider(self, name: str) -> "LLMProvider | None":
+        """Returns a provider, building it from its factory on first use."""
+        provider = self.providers.get(name)
+        if provider is not None:
+            return provider
+        factory = self._provider_factories.pop(name, None)
+        if factory is None:
+            return None
+        try:
+            provider = factory()
+        except ValueError as e:
+            logger.warning("Provider '%s' not initialized: %s", name, e)
+            return None
+        logger.info("Initialized provider '%s'.", name)
+        self.providers[name] = provider
+        return provider
+
+    def _ensure_all_providers(self) -> Dict[str, LLMProvider]:
+        """Instantiates every remaining factory (used by the racing path)."""
+        for name in list(self._provider_factories):
+            self._get_or_create_provider(name)
+        return self.providers
+
+    def _resolve_provider(self, provider_name: str) -> LLMProvider:
+        """Looks up a provider by name, falling back to any available one."""
+        provider = self._get_or_create_provider(provider_name.lower())
+        if not provider:
+            # Fallback if the requested provider isn't available but others are
+            for name in [*self.providers, *self._provider_factories]:
+                provider = self._get_or_create_provider(name)
+                if provider:
+                    logger.warning("Provider '%s' not found. Using default: '%s'.", provider_name, name)
+                    return provider
+            raise ValueError(f"No LLM providers are available. Cannot route request for '{provider_name}'.")
+        return provider
 
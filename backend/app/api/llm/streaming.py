@@ -0,0 +1,108 @@
+import logging
+from typing import Optional, Union
+
+from backend.app.models.context import VisualizationSpec
+
+logger = logging.getLogger(__name__)
+
+
+def assemble_result(explanation_text: str, json_text: Optional[str]) -> Union[str, "VisualizationSpec"]:
+    """
+    Builds the final provider result from scanner output: a VisualizationSpec
+    when a valid ```json block was streamed, otherwise the plain explanation
+    text. The streamed prose takes precedence over the spec's own
+    explanation field, matching the non-streaming parse behaviour.
+    """
+    if json_text:
+        try:
+            spec = VisualizationSpec.model_validate_json(json_text)
+            if explanation_text:
+                spec.explanation = explanation_text
+            return spec
+        except Exception as e:
+            logger.warning("Streamed JSON block failed to parse into a spec: %s", e)
+            # Fall back to the text response if the JSON is invalid
+            return explanation_text or json_text
+    return explanation_text
+
+
+class FencedJSONScanner:
+    """
+    Incremental splitter for streamed LLM output that may contain a
+    ```json ... ``` block after the prose explanation.
+
+    Chunks are fed in as they arrive; the scanner returns the displayable
+    explanation text immediately and accumulates the fenced JSON content
+    separately. This replaces the old post-hoc regex scan of the full
+    response: no chunk is examined twice, fence markers split across chunk
+    boundaries are handled, and memory stays bounded by the JSON block
+    rather than the full reply.
+    """
+
+    FENCE_OPEN = "```json"
+    FENCE_CLOSE = "```"
+
+    def __init__(self):
+        self._buffer = ""       # Unreleased text (may end in a partial fence marker)
+        self._json_parts = []   # Accumulated content of the json block
+        self._in_json = False
+        self._json_complete = False
+
+    def feed(self, chunk: str) -> str:
+        """
+        Consumes one streamed chunk and returns whatever explanation text can
+        be released to the caller (possibly empty while inside a fence).
+        """
+        self._buffer += chunk
+        released = []
+
+        while True:
+            if not self._in_json:
+                open_index = self._buffer.find(self.FENCE_OPEN)
+                if open_index != -1:
+                    released.append(self._buffer[:open_index])
+                    self._buffer = self._buffer[open_index + len(self.FENCE_OPEN):]
+                    self._in_json = True
+                    continue
+                # Hold back a potential partial fence marker at the tail;
+                # everything before it is safe to release.
+                holdback = len(self.FENCE_OPEN) - 1
+                if len(self._buffer) > holdback:
+                    released.append(self._buffer[:-holdback])
+                    self._buffer = self._buffer[-holdback:]
+                break
+            else:
+                close_index = self._buffer.find(self.FENCE_CLOSE)
+                if close_index != -1:
+                    self._json_parts.append(self._buffer[:close_index])
+                    self._buffer = self._buffer[close_index + len(self.FENCE_CLOSE):]
+                    self._in_json = False
+                    self._json_complete = True
+                    continue
+                # Hold back a potential partial closing fence; the rest is JSON.
+                holdback = len(self.FENCE_CLOSE) - 1
+                if len(self._buffer) > holdback:
+                    self._json_parts.append(self._buffer[:-holdback])
+                    self._buffer = self._buffer[-holdback:]
+                break
+
+        return "".join(released)
+
+    def finalize(self) -> str:
+        """
+        Flushes any held-back text once the stream has ended and returns it.
+        An unterminated json block is kept as JSON (truncated responses).
+        """
+        remainder = self._buffer
+        self._buffer = ""
+        if self._in_json:
+            self._json_parts.append(remainder)
+            return ""
+        return remainder
+
+    @property
+    def json_text(self) -> Optional[str]:
+        """The content of the ```json block, or None if none was seen."""
+        if not self._json_parts and not self._in_json and not self._json_complete:
+            return None
+        return "".join(self._json_parts).strip() or None
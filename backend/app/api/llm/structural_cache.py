@@ -0,0 +1,126 @@
+"""
+Structural prompt cache for visualization requests.
+
+Many follow-up queries are near-duplicates of an earlier one with only the
+literals changed ("plot sin(2*x)" vs "plot sin(3*x)"). Instead of paying a
+full LLM round-trip for each, we key a cache on the *skeleton* of the user
+message — the text with numeric literals and single-letter parameter names
+replaced by typed placeholders — and store the returned VisualizationSpec
+as a template with the same literals abstracted out. On a skeleton hit the
+new query's literals are substituted back into the template, turning a
+~second LLM call into a cache lookup.
+"""
+import logging
+import re
+from typing import List, Optional, Tuple
+
+from cachetools import LRUCache
+
+from backend.app.models.context import LearningContext, VisualizationSpec
+
+logger = logging.getLogger(__name__)
+
+# Numeric literals (ints/floats, optional sign) not embedded in identifiers
+_NUM_RE = re.compile(r'(?<![\w.])-?\d+(?:\.\d+)?')
+# Standalone single-letter names, treated as tunable parameters
+_PARAM_RE = re.compile(r'\b[a-zA-Z]\b')
+# Single letters that are English words, not identifiers, unless they sit
+# directly against math syntax ("plot a graph" vs "plot a*x^2")
+_WORD_LETTERS = {"a", "A", "I"}
+_MATH_ADJACENT = set("0123456789+-*/^=(),.")
+
+
+class StructuralSpecCache:
+    """LRU cache mapping (message skeleton, topic) -> spec template."""
+
+    def __init__(self, maxsize: int = 1024):
+        self._cache: LRUCache = LRUCache(maxsize=maxsize)
+
+    @staticmethod
+    def _skeletonize(text: str) -> Tuple[str, List[str]]:
+        """
+        Replaces literals in the text with placeholders and returns the
+        skeleton plus the extracted literals in scan order.
+        """
+        literals: List[str] = []
+
+        def _capture_num(match):
+            literals.append(match.group(0))
+            return "<NUM>"
+
+        def _capture_param(match):
+            letter = match.group(0)
+            if letter in _WORD_LETTERS:
+                start, end = match.span()
+                before = match.string[start - 1] if start else ""
+                after = match.string[end] if end < len(match.string) else ""
+                if before not in _MATH_ADJACENT and after not in _MATH_ADJACENT:
+                    # An article ("plot a graph"), not a tunable parameter
+                    return letter
+            literals.append(letter)
+            return "<PARAM>"
+
+        skeleton = _NUM_RE.sub(_capture_num, text)
+        skeleton = _PARAM_RE.sub(_capture_param, skeleton)
+        return skeleton, literals
+
+    @staticmethod
+    def _key(skeleton: str, context: LearningContext) -> Tuple[str, Optional[str]]:
+        # The same skeleton can mean different things under different topics
+        return (skeleton, context.current_topic)
+
+    def lookup(self, user_message: str, context: LearningContext) -> Optional[VisualizationSpec]:
+        """
+        Returns a spec rebuilt from a cached template with this message's
+        literals substituted in, or None when there is no structural match.
+        """
+        skeleton, literals = self._skeletonize(user_message)
+        entry = self._cache.get(self._key(skeleton, context))
+        if entry is None:
+            return None
+
+        template_json, literal_count = entry
+        if len(literals) != literal_count:
+            return None
+
+        rebuilt = template_json
+        for index, literal in enumerate(literals):
+            rebuilt = rebuilt.replace(f"<L{index}>", literal)
+        try:
+            return VisualizationSpec.model_validate_json(rebuilt)
+        except Exception as e:
+            logger.warning("Structural cache template failed to rebuild: %s", e)
+            return None
+
+    def store(self, user_message: str, context: LearningContext, spec: VisualizationSpec) -> None:
+        """
+        Abstracts the message's literals out of the spec and caches the
+        resulting template under the message skeleton. Messages whose
+        literals cannot be mapped back unambiguously are not cached: a
+        wrong answer from the cache is far worse than a spare LLM call.
+        """
+        skeleton, literals = self._skeletonize(user_message)
+
+        # Refuse ambiguous literal sets. A repeated literal ("from -2 to 2"
+        # after sign merging, "sin(2x) ... 2 terms") cannot be substituted
+        # positionally, and a literal that is a substring of another ("2"
+        # inside "-2" or "12") would corrupt the other's occurrences.
+        unique_literals = set(literals)
+        if len(unique_literals) != len(literals):
+            return
+        for a in unique_literals:
+            for b in unique_literals:
+                if a != b and a in b:
+                    return
+
+        template = spec.model_dump_json()
+        for index, literal in enumerate(literals):
+            # Replace only standalone occurrences: no identifier/number
+            # characters on either side, and no leading sign, so "2" never
+            # matches inside "20", "1.2" or "-2".
+            template = re.sub(
+                rf'(?<![\w.\-]){re.escape(literal)}(?![\w.])',
+                f"<L{index}>",
+                template,
+            )
+        self._cache[self._key(skeleton, context)] = (template, len(literals))
@@ -0,0 +1,243 @@
+import asyncio
+import logging
+from typing import Dict, Any, Optional
+from fastapi import APIRouter, HTTPException
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel
+
+from backend.app.api.context.protocol import ContextProtocol
+from backend.app.api.llm.router import LLMRouter
+from backend.app.api.render.js_generator import InteractiveJSGenerator
+from backend.app.api.render.plotly_generator import PlotlyGenerator
+from backend.app.api.render.manim_engine import ManimRenderer
+from backend.app.core.cache import RenderCache, SemanticCache
+from backend.app.core.fastjson import json_dumps
+from backend.app.models.context import VisualizationSpec
+
+# --- Main API Router ---
+# This router is included by the FastAPI app in backend/app/main.py under
+# the '/api' prefix, so the chat endpoint below is served at
+# '/api/v1/chat/{session_id}' — the URL the Gradio frontend calls.
+router = APIRouter()
+
+logger = logging.getLogger(__name__)
+
+# --- Shared Service Instances ---
+# These are created once at import time and reused across requests.
+context_protocol = ContextProtocol()
+llm_router = LLMRouter()
+js_generator = InteractiveJSGenerator()
+plotly_generator = PlotlyGenerator()
+manim_renderer = ManimRenderer()
+semantic_cache = SemanticCache()
+render_cache = RenderCache()
+
+
+class ChatRequest(BaseModel):
+    """Payload sent by the frontend for a single chat turn."""
+    message: str
+    provider: str = "openai"
+    # Race all providers and take the first response. Lower latency, but
+    # the losing calls are still billed — off by default.
+    speculative: bool = False
+
+
+async def _render_visualization(spec: VisualizationSpec) -> Optional[Dict[str, Any]]:
+    """
+    Dispatches a VisualizationSpec to the matching renderer and returns the
+    frontend-facing visualization payload, or None if the spec is
+    text-only or rendering fails.
+    """
+    # Identical specs (common when users iterate back and forth) skip the
+    # renderer entirely.
+    spec_key = RenderCache.spec_key(spec)
+    cached_payload = render_cache.get(spec_key)
+    if cached_payload is not None:
+        return cached_payload
+
+    try:
+        if spec.type == "interactive_js":
+            render_result = await js_generator.generate_interactive_visualization(spec)
+            payload = {"type": "html", "url": f"/static/{render_result['html_path']}"}
+        elif spec.type == "plotly":
+            figure = await plotly_generator.generate_plotly_visualization(spec)
+            payload = {"type": "plotly", "figure": figure.to_json()}
+        elif spec.type == "manim":
+            video_path = await manim_renderer.render_scene(spec)
+            payload = {"type": "video", "url": f"/static/{video_path}"}
+        else:
+            # "text_explanation" and unknown types render nothing
+            return None
+        render_cache.put(spec_key, payload)
+        return payload
+    except Exception:
+        # logging formats the traceback lazily, only if a handler consumes it
+        logger.exception("Visualization render failed", extra={"spec_type": spec.type})
+        return None
+
+
+@router.post("/v1/chat/{session_id}")
+async def chat(session_id: str, request: ChatRequest) -> Dict[str, Any]:
+    """
+    Handles one chat turn: routes the message to the LLM, renders any
+    requested visualization, and persists the turn in the session context.
+    """
+    if not request.message.strip():
+        raise HTTPException(status_code=400, detail="Message must not be empty.")
+
+    context = await context_protocol.get_context(session_id)
+
+    # Build the LLM message list from the current history plus this turn
+    # *before* launching persistence, so the user-message DB write can run
+    # concurrently with the (much slower) LLM call instead of in front of it.
+    # The history list is cached per session and extended incrementally, so
+    # only the new turn allocates a dict here.
+    history = await context_protocol.get_llm_messages(session_id)
+    llm_messages = [*history, {"role": "user", "content": request.message}]
+
+    # Near-duplicate queries skip the LLM and renderer entirely; the turn is
+    # still recorded in the session context so the history stays faithful.
+    # The recent history tail is part of the cache key, so follow-ups like
+    # "tell me more" only match within a comparable conversation. Snapshot
+    # the tail now: the cached history list is extended in place as the turn
+    # is persisted, and store() must key on the same pre-turn context.
+    cache_context = history[-semantic_cache.CONTEXT_WINDOW:]
+    cached_response = await semantic_cache.lookup(request.message, cache_context)
+    if cached_response is not None:
+        await context_protocol.commit_turn(
+            session_id, request.message, cached_response.get("explanation", "")
+        )
+        return cached_response
+
+    persist_task = asyncio.create_task(
+        context_protocol.add_message(session_id, "user", request.message)
+    )
+    llm_task = asyncio.create_task(
+        llm_router.route_speculative(llm_messages, context)
+        if request.speculative
+        else llm_router.route_request(request.provider, llm_messages, context)
+    )
+    try:
+        _, llm_result = await asyncio.gather(persist_task, llm_task)
+    except ValueError as e:
+        # No provider available for this request
+        raise HTTPException(status_code=503, detail=str(e))
+    except Exception:
+        logger.exception("LLM request failed", extra={"session_id": session_id})
+        # Keep the user-facing message short and free of internals
+        raise HTTPException(status_code=500, detail="LLM request failed — please retry.")
+
+    # The router returns either a plain text reply or a structured spec.
+    visualization = None
+    if isinstance(llm_result, VisualizationSpec):
+        explanation = llm_result.explanation
+        # Rendering (seconds, for Manim) and persisting the assistant reply
+        # are independent, so run them concurrently and hide the DB write
+        # behind the render time.
+        render_task = asyncio.create_task(_render_visualization(llm_result))
+        persist_task = asyncio.create_task(
+            context_protocol.add_message(session_id, "assistant", explanation)
+        )
+        visualization, _ = await asyncio.gather(render_task, persist_task)
+        # Record the visualization result with one small follow-up write,
+        # only once the render outcome is known.
+        await context_protocol.update_context(session_id, {
+            "last_visualization_spec": llm_result,
+            "last_render_output": visualization.get("url") if visualization else None,
+        })
+    else:
+        explanation = llm_result
+        await context_protocol.add_message(session_id, "assistant", explanation)
+
+    response = {"explanation": explanation, "visualization": visualization}
+    # Cache only turns that produced a real visualization: a plain-string
+    # reply can be a provider error message, and the semantic cache table
+    # has no TTL to age a poisoned entry out.
+    if isinstance(llm_result, VisualizationSpec):
+        await semantic_cache.store(request.message, response, cache_context)
+    return response
+
+
+def _sse_event(event: Dict[str, Any]) -> str:
+    """Formats a dict as a server-sent-events data frame."""
+    return f"data: {json_dumps(event)}\n\n"
+
+
+@router.post("/v1/chat/{session_id}/stream")
+async def chat_stream(session_id: str, request: ChatRequest) -> StreamingResponse:
+    """
+    Streaming variant of the chat endpoint. Emits the explanation as
+    'delta' events as soon as text is available, then a final 'complete'
+    event carrying the full response payload (including any visualization),
+    so the frontend can show text while the renderer is still working.
+    """
+    if not request.message.strip():
+        raise HTTPException(status_code=400, detail="Message must not be empty.")
+
+    async def event_stream():
+        context = await context_protocol.get_context(session_id)
+        history = await context_protocol.get_llm_messages(session_id)
+        llm_messages = [*history, {"role": "user", "content": request.message}]
+
+        # Cache hits complete immediately; keyed on the pre-turn history
+        # tail plus the message so follow-up turns are matched in context.
+        cache_context = history[-semantic_cache.CONTEXT_WINDOW:]
+        cached_response = await semantic_cache.lookup(request.message, cache_context)
+        if cached_response is not None:
+            await context_protocol.commit_turn(
+                session_id, request.message, cached_response.get("explanation", "")
+            )
+            yield _sse_event({"type": "complete", **cached_response})
+            return
+
+        # Persist the user message while the LLM stream is in flight.
+        persist_task = asyncio.create_task(
+            context_protocol.add_message(session_id, "user", request.message)
+        )
+
+        # Consume the provider stream: explanation text is relayed to the
+        # client as 'delta' events the moment tokens arrive, while the fenced
+        # JSON spec (if any) is accumulated provider-side and delivered in
+        # the final 'result' event.
+        llm_result = None
+        try:
+            async for event in llm_router.stream_request(request.provider, llm_messages, context):
+                if event["type"] == "text_delta":
+                    yield _sse_event({"type": "delta", "text": event["text"]})
+                elif event["type"] == "result":
+                    llm_result = event["value"]
+            await persist_task
+        except Exception:
+            logger.exception("LLM stream failed", extra={"session_id": session_id})
+            yield _sse_event({"type": "error", "detail": "LLM request failed — please retry."})
+            return
+
+        if llm_result is None:
+            yield _sse_event({"type": "error", "detail": "LLM request produced no result — please retry."})
+            return
+
+        visualization = None
+        if isinstance(llm_result, VisualizationSpec):
+            explanation = llm_result.explanation
+            render_task = asyncio.create_task(_render_visualization(llm_result))
+            persist_task = asyncio.create_task(
+                context_protocol.add_message(session_id, "assistant", explanation)
+            )
+            visualization, _ = await asyncio.gather(render_task, persist_task)
+            await context_protocol.update_context(session_id, {
+                "last_visualization_spec": llm_result,
+                "last_render_output": visualization.get("url") if visualization else None,
+            })
+        else:
+            # Plain-text replies were already streamed out as deltas above.
+            explanation = llm_result
+            await context_protocol.add_message(session_id, "assistant", explanation)
+
+        response = {"explanation": explanation, "visualization": visualization}
+        # Same gating as the non-streaming endpoint: never persist a
+        # possible error string into the TTL-less semantic cache.
+        if isinstance(llm_result, VisualizationSpec):
+            await semantic_cache.store(request.message, response, cache_context)
+        yield _sse_event({"type": "complete", **response})
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
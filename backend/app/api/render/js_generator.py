@@ -1,18 +1,20 @@
+import asyncio
 import json
+import logging
+import string
 from typing import Dict, Any
 from pathlib import Path
 import hashlib
+from cachetools import LRUCache
 from backend.app.models.context import VisualizationSpec
 
-class InteractiveJSGenerator:
-    """
-    Generates a self-contained, interactive HTML/JS visualization based on a structured spec.
-    The output is an HTML file that can be embedded in an iframe.
-    """
-    def __init__(self):
-        # Define a comprehensive base template for the HTML file.
-        # This template includes placeholders for injecting controls, variables, and functions.
-        self.base_html_template = """
+logger = logging.getLogger(__name__)
+
+# Templates are parsed once at import time. string.Template.substitute is a
+# single compiled-regex pass, unlike str.format which re-parses the format
+# string on every call — noticeable for the ~6KB page template and for the
+# per-parameter snippets when specs carry many sliders.
+_BASE_HTML_TEMPLATE = string.Template("""
 <!DOCTYPE html>
 <html>
 <head>
@@ -21,7 +23,7 @@ class InteractiveJSGenerator:
     <title>Interactive Visualization</title>
     <style>
         /* Basic styling for a clean look within an iframe */
-        body {{ 
+        body { 
             margin: 0; 
             padding: 10px; 
             font-family: -apple-system, BlinkMacSystemFont, "Segoe UI", Roboto, Helvetica, Arial, sans-serif;
@@ -31,8 +33,8 @@ class InteractiveJSGenerator:
             height: 100vh;
             box-sizing: border-box;
             background-color: #f9f9f9;
-        }}
-        .controls {{ 
+        }
+        .controls { 
             margin-bottom: 10px; 
             display: flex; 
             flex-wrap: wrap; 
@@ -43,17 +45,17 @@ class InteractiveJSGenerator:
             border-radius: 8px;
             width: 100%;
             box-sizing: border-box;
-        }}
-        .control-group {{ 
+        }
+        .control-group { 
             display: flex; 
             align-items: center; 
             gap: 8px; 
-        }}
-        .control-group label {{ 
+        }
+        .control-group label { 
             font-weight: 500; 
             font-size: 14px;
-        }}
-        .value-display {{ 
+        }
+        .value-display { 
             min-width: 40px; 
             text-align: center; 
             font-weight: normal; 
@@ -62,19 +64,19 @@ class InteractiveJSGenerator:
             padding: 2px 4px;
             border-radius: 4px;
             border: 1px solid #ddd;
-        }}
-        canvas {{ 
+        }
+        canvas { 
             border: 1px solid #ccc; 
             background-color: white; 
             width: 100%;
             flex-grow: 1; /* Allow canvas to take remaining space */
             box-sizing: border-box;
-        }}
+        }
     </style>
 </head>
 <body>
     <div class="controls">
-        {controls_html}
+        ${controls_html}
     </div>
     <canvas id="visualization-canvas"></canvas>
 
@@ -83,27 +85,75 @@ class InteractiveJSGenerator:
         const ctx = canvas.getContext('2d');
 
         // --- Injected State and Parameters ---
-        {variable_declarations}
+        ${variable_declarations}
 
         // --- Injected Mathematical Function ---
-        {math_function_js}
+        ${math_function_js}
 
         // --- Injected Parameter Update Functions ---
-        {update_functions_js}
+        ${update_functions_js}
         
         // --- Core Drawing and Resize Logic ---
-        function resizeCanvas() {{
+
+        // The axes and grid don't depend on the parameters, so they are
+        // pre-rendered once per resize into an offscreen bitmap and blitted
+        // with a single drawImage per frame — slider scrubbing only pays
+        // for the curve itself.
+        let gridBitmap = null;
+
+        function buildGrid(width, height, dpr) {
+            const grid = (typeof OffscreenCanvas !== 'undefined')
+                ? new OffscreenCanvas(width * dpr, height * dpr)
+                : Object.assign(document.createElement('canvas'),
+                                { width: width * dpr, height: height * dpr });
+            const gctx = grid.getContext('2d');
+            gctx.scale(dpr, dpr);
+
+            // Define the plot range (can be made dynamic later)
+            const xMin = -10, xMax = 10;
+            const yMin = -10, yMax = 10;
+
+            const xScale = width / (xMax - xMin);
+            const yScale = height / (yMax - yMin);
+            const xOffset = -xMin * xScale;
+            const yOffset = yMax * yScale;
+
+            // Draw axes
+            gctx.strokeStyle = '#ccc';
+            gctx.lineWidth = 1;
+            gctx.beginPath();
+            gctx.moveTo(0, yOffset); gctx.lineTo(width, yOffset); // X-axis
+            gctx.moveTo(xOffset, 0); gctx.lineTo(xOffset, height); // Y-axis
+            gctx.stroke();
+
+            // Draw grid lines (optional)
+            gctx.strokeStyle = '#eee';
+            for (let i = Math.floor(xMin); i <= Math.ceil(xMax); i++) {
+                if (i === 0) continue;
+                const gridX = xOffset + i * xScale;
+                gctx.beginPath(); gctx.moveTo(gridX, 0); gctx.lineTo(gridX, height); gctx.stroke();
+            }
+            for (let i = Math.floor(yMin); i <= Math.ceil(yMax); i++) {
+                if (i === 0) continue;
+                const gridY = yOffset - i * yScale;
+                gctx.beginPath(); gctx.moveTo(0, gridY); gctx.lineTo(width, gridY); gctx.stroke();
+            }
+            return grid;
+        }
+
+        function resizeCanvas() {
             // Resize canvas to fit its container's displayed size
             const dpr = window.devicePixelRatio || 1;
             const rect = canvas.getBoundingClientRect();
             canvas.width = rect.width * dpr;
             canvas.height = rect.height * dpr;
             ctx.scale(dpr, dpr);
+            gridBitmap = buildGrid(rect.width, rect.height, dpr);
             // Redraw after resizing
-            draw();
-        }}
+            scheduleDraw();
+        }
 
-        function draw() {{
+        function draw() {
             if (!canvas || !ctx) return;
             const width = canvas.clientWidth;
             const height = canvas.clientHeight;
@@ -120,65 +170,75 @@ class InteractiveJSGenerator:
             const xOffset = -xMin * xScale;
             const yOffset = yMax * yScale;
 
-            // Draw axes
-            ctx.strokeStyle = '#ccc';
-            ctx.lineWidth = 1;
-            ctx.beginPath();
-            ctx.moveTo(0, yOffset); ctx.lineTo(width, yOffset); // X-axis
-            ctx.moveTo(xOffset, 0); ctx.lineTo(xOffset, height); // Y-axis
-            ctx.stroke();
-            
-            // Draw grid lines (optional)
-            ctx.strokeStyle = '#eee';
-            for (let i = Math.floor(xMin); i <= Math.ceil(xMax); i++) {{
-                if (i === 0) continue;
-                const gridX = xOffset + i * xScale;
-                ctx.beginPath(); ctx.moveTo(gridX, 0); ctx.lineTo(gridX, height); ctx.stroke();
-            }}
-            for (let i = Math.floor(yMin); i <= Math.ceil(yMax); i++) {{
-                if (i === 0) continue;
-                const gridY = yOffset - i * yScale;
-                ctx.beginPath(); ctx.moveTo(0, gridY); ctx.lineTo(width, gridY); ctx.stroke();
-            }}
+            // Blit the pre-rendered axes + grid in one call
+            if (gridBitmap) {
+                ctx.drawImage(gridBitmap, 0, 0, width, height);
+            }
 
-            // Draw function graph
+            // Draw function graph: accumulate into a Path2D and stroke
+            // once, letting the browser submit a single tessellated path.
             ctx.strokeStyle = '#007bff';
             ctx.lineWidth = 2;
-            ctx.beginPath();
 
-            let lastValidY = null;
-            for (let px = 0; px < width; px++) {{
+            const path = new Path2D();
+            // Sampling every 2px on wide canvases halves the work with no
+            // visible difference at display resolution.
+            const step = width > 1200 ? 2 : 1;
+            let started = false;
+            for (let px = 0; px < width; px += step) {
                 const x = (px - xOffset) / xScale;
-                const y = mathFunction(x, {parameter_names_list}); // Pass parameters
-                
-                if (isFinite(y)) {{
+                const y = mathFunction(x, ${parameter_names_list}); // Pass parameters
+
+                if (isFinite(y)) {
                     const py = yOffset - y * yScale;
-                    // If the last point was not valid, move to this new point to start a new line segment
-                    if (lastValidY === null) {{
-                        ctx.moveTo(px, py);
-                    }} else {{
-                        ctx.lineTo(px, py);
-                    }}
-                    lastValidY = py;
-                }} else {{
-                    // Current point is invalid (e.g., tan(pi/2)), reset last valid point
-                    lastValidY = null;
-                }}
-            }}
-            ctx.stroke();
-        }}
+                    // Start a new segment after a gap (e.g. tan(pi/2))
+                    if (!started) {
+                        path.moveTo(px, py);
+                        started = true;
+                    } else {
+                        path.lineTo(px, py);
+                    }
+                } else {
+                    started = false;
+                }
+            }
+            ctx.stroke(path);
+        }
         
+        // --- Redraw Scheduling ---
+        // All redraw requests funnel through one requestAnimationFrame gate,
+        // so any number of slider events per frame collapse into one draw()
+        // at display refresh rate.
+        let rafScheduled = false;
+        function scheduleDraw() {
+            if (rafScheduled) return;
+            rafScheduled = true;
+            requestAnimationFrame(() => { rafScheduled = false; draw(); });
+        }
+
         // --- Communication with Parent Frame ---
-        function notifyParent(variable, value) {{
-            // Use postMessage for secure cross-origin communication
-            if (window.parent) {{
-                window.parent.postMessage({{ 
-                    type: 'iframe_variable_update', 
-                    variable: variable, 
-                    value: value 
-                }}, '*'); // Replace '*' with target origin in production for security
-            }}
-        }}
+        // Slider drags fire oninput faster than the display refresh; only
+        // the latest value per variable matters, so updates are merged into
+        // one batched postMessage per animation frame instead of one frame
+        // per tick.
+        let pendingVars = null;
+        function flushParentUpdates() {
+            const variables = pendingVars;
+            pendingVars = null;
+            if (window.parent) {
+                window.parent.postMessage({
+                    type: 'iframe_variable_update',
+                    variables: variables
+                }, '*'); // Replace '*' with target origin in production for security
+            }
+        }
+        function notifyParent(variable, value) {
+            if (pendingVars === null) {
+                pendingVars = {};
+                requestAnimationFrame(flushParentUpdates);
+            }
+            pendingVars[variable] = value; // later ticks overwrite earlier ones
+        }
 
         // --- Initialization ---
         window.addEventListener('resize', resizeCanvas);
@@ -188,8 +248,46 @@ class InteractiveJSGenerator:
     </script>
 </body>
 </html>
-"""
-        print("InteractiveJSGenerator initialized with updated templates.")
+""")
+
+_SLIDER_CONTROL_TEMPLATE = string.Template("""
+            <div class="control-group">
+                <label for="${name}">${label}:</label>
+                <input type="range" id="${name}" min="${min}" max="${max}"
+                       step="${step}" value="${default}"
+                       oninput="update_${name}(this.value)">
+                <span id="${name}_value" class="value-display">${default}</span>
+            </div>
+            """)
+
+_UPDATE_FUNCTION_TEMPLATE = string.Template("""
+            function update_${name}(value) {
+                ${name} = parseFloat(value);
+                document.getElementById('${name}_value').textContent = value;
+                scheduleDraw(); // Coalesced redraw on the next animation frame
+                notifyParent('${name}', ${name}); // Notify the parent Gradio app
+            }
+            """)
+
+# Module-level so every instance shares one cache: spec hash -> relative
+# output path. Hits are answered without a stat() or any template work.
+_PATH_CACHE: LRUCache = LRUCache(maxsize=512)
+
+# Single-flight table of in-flight generations keyed by spec hash:
+# concurrent requests for the same spec await one generation instead of
+# racing each other to write the same file. Shared with three_engine.
+_INFLIGHT: Dict[str, asyncio.Future] = {}
+
+
+class InteractiveJSGenerator:
+    """
+    Generates a self-contained, interactive HTML/JS visualization based on a structured spec.
+    The output is an HTML file that can be embedded in an iframe.
+    """
+    def __init__(self):
+        # Templates and the path cache live at module scope, so instances are
+        # stateless and interchangeable.
+        logger.info("InteractiveJSGenerator initialized with precompiled templates.")
 
     async def generate_interactive_visualization(self, spec: VisualizationSpec) -> Dict[str, str]:
         """
@@ -212,6 +310,46 @@ class InteractiveJSGenerator:
         if not function_expr:
              raise ValueError("Interactive JS spec is missing the required 'function_expr' in its content.")
 
+        # --- Cache Check (before any template work) ---
+        # The cache key is derived from the spec inputs rather than the
+        # rendered page, so a hit skips template assembly entirely and only
+        # hashes a few hundred bytes.
+        key_blob = json.dumps({"fn": function_expr, "params": parameters}, sort_keys=True)
+        file_hash = hashlib.blake2b(key_blob.encode('utf-8'), digest_size=16).hexdigest()
+        cached_path = _PATH_CACHE.get(file_hash)
+        if cached_path is not None:
+            return {"html_path": cached_path}
+
+        # Single-flight: a concurrent request for the same spec awaits the
+        # first one's result instead of generating (and writing) twice.
+        existing = _INFLIGHT.get(file_hash)
+        if existing is not None:
+            return {"html_path": await existing}
+        future: asyncio.Future = asyncio.get_running_loop().create_future()
+        _INFLIGHT[file_hash] = future
+        try:
+            result = await self._generate_uncached(function_expr, parameters, file_hash)
+            future.set_result(result)
+            return {"html_path": result}
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            _INFLIGHT.pop(file_hash, None)
+
+    async def _generate_uncached(self, function_expr: str, parameters: Dict[str, Any], file_hash: str) -> str:
+        """Builds (or finds on disk) the HTML for a spec; returns its relative path."""
+        temp_dir = Path("runtime/cache/generated_assets/html")
+        temp_dir.mkdir(parents=True, exist_ok=True)
+        file_path = temp_dir / f"viz_{file_hash}.html"
+        relative_path = Path("generated_assets/html") / file_path.name
+        # The stat goes through a worker thread: on network or busy disks a
+        # sync exists() would stall every other request on the event loop.
+        if await asyncio.to_thread(file_path.exists):
+            logger.debug("Interactive HTML found in cache: %s", file_path)
+            _PATH_CACHE[file_hash] = str(relative_path)
+            return str(relative_path)
+
         # --- Generate HTML and JS parts from the spec ---
         controls_html_parts = []
         variable_declarations = []
@@ -219,29 +357,22 @@ class InteractiveJSGenerator:
         parameter_names_list = list(parameters.keys())
 
         for param_name, config in parameters.items():
+            default = config.get('default', 0)
             # Generate slider control HTML
-            controls_html_parts.append(f"""
-            <div class="control-group">
-                <label for="{param_name}">{config.get('label', param_name)}:</label>
-                <input type="range" id="{param_name}" min="{config.get('min', -10)}" max="{config.get('max', 10)}"
-                       step="{config.get('step', 0.1)}" value="{config.get('default', 0)}"
-                       oninput="update_{param_name}(this.value)">
-                <span id="{param_name}_value" class="value-display">{config.get('default', 0)}</span>
-            </div>
-            """)
-            
+            controls_html_parts.append(_SLIDER_CONTROL_TEMPLATE.substitute(
+                name=param_name,
+                label=config.get('label', param_name),
+                min=config.get('min', -10),
+                max=config.get('max', 10),
+                step=config.get('step', 0.1),
+                default=default,
+            ))
+
             # Generate JavaScript variable declaration for the parameter
-            variable_declarations.append(f"let {param_name} = {config.get('default', 0)};")
-            
+            variable_declarations.append(f"let {param_name} = {default};")
+
             # Generate the update function for this parameter
-            update_functions_js_parts.append(f"""
-            function update_{param_name}(value) {{
-                {param_name} = parseFloat(value);
-                document.getElementById('{param_name}_value').textContent = value;
-                draw(); // Redraw the visualization on change
-                notifyParent('{param_name}', {param_name}); // Notify the parent Gradio app
-            }}
-            """)
+            update_functions_js_parts.append(_UPDATE_FUNCTION_TEMPLATE.substitute(name=param_name))
 
         # --- Generate the core mathematical function using the safer Function constructor ---
         # This prevents it from accessing the local scope, which is safer than direct eval().
@@ -256,7 +387,7 @@ class InteractiveJSGenerator:
         """
 
         # --- Assemble the final HTML file content ---
-        full_html = self.base_html_template.format(
+        full_html = _BASE_HTML_TEMPLATE.substitute(
             controls_html="\n".join(controls_html_parts),
             variable_declarations="\n        ".join(variable_declarations),
             math_function_js=math_function_js,
@@ -265,22 +396,13 @@ class InteractiveJSGenerator:
         )
 
         # --- Save the HTML to a file and return its path ---
-        temp_dir = Path("runtime/cache/generated_assets/html")
-        temp_dir.mkdir(parents=True, exist_ok=True)
-
-        # Create a unique filename based on the hash of the generated content
-        file_hash = hashlib.md5(full_html.encode()).hexdigest()
-        file_path = temp_dir / f"viz_{file_hash}.html"
-
-        # Write to file only if it doesn't already exist (caching)
-        if not file_path.exists():
-             file_path.write_text(full_html, encoding='utf-8')
-             print(f"Generated and saved new interactive HTML to: {file_path}")
-        else:
-             print(f"Interactive HTML found in cache: {file_path}")
+        # The write goes through a worker thread so the event loop isn't
+        # blocked on slow disks — also why this method stays async despite
+        # being mostly CPU-bound string work.
+        await asyncio.to_thread(file_path.write_text, full_html, 'utf-8')
+        logger.debug("Generated and saved new interactive HTML to: %s", file_path)
+        _PATH_CACHE[file_hash] = str(relative_path)
 
         # The Gradio app will serve the `runtime/cache` directory at `/static`.
         # Return the path relative to that mount point.
-        relative_path = Path("generated_assets/html") / file_path.name
-
-        return {"html_path": str(relative_path)}
\ No newline at end of file
+        return str(relative_path)
\ No newline at end of file
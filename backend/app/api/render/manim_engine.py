@@ -1,12 +1,14 @@
+import asyncio
 import modal
 import hashlib
+from cachetools import LRUCache
 from pathlib import Path
 from typing import Dict, Any
 from backend.app.models.context import VisualizationSpec
 
 try:
     render_manim_scene_modal = modal.Function.lookup(
-        "ViualMathAi-backend", "render_manim_scene"
+        "VisualMathAi-backend", "render_manim_scene"
     )
     MODAL_AVAILABLE = True
     print("Successfully connected to Modal function 'render_manim_scene'.")
@@ -20,7 +22,12 @@ except modal.exception.NotFoundError:
 class ManimRenderer:
     """
     Client for the Modal-based sandboxed Manim rendering service.
-    
+
+    Note that no numeric evaluation happens in this process: the scene code
+    arrives as an opaque LLM-generated string and every frame is computed
+    remotely inside the Modal container, so local JIT compilation of the
+    render math is not possible from here.
+
     This class's responsibility is to:
     1. Check a local cache for previously rendered videos.
     2. If not cached, call the remote Modal function to perform the rendering.
@@ -37,6 +44,12 @@ class ManimRenderer:
         """
         self.output_dir = Path(output_dir)
         self.output_dir.mkdir(parents=True, exist_ok=True)
+        # Concurrent requests for the same scene share one remote render
+        # instead of each paying the multi-second Modal round trip.
+        self._inflight: Dict[str, asyncio.Future] = {}
+        # In-memory tier in front of the on-disk video cache: hash -> relative
+        # path, so hot repeats skip even the stat() syscall.
+        self._path_cache: LRUCache = LRUCache(maxsize=512)
         print(f"ManimRenderer (Modal Client) initialized. Local cache: {self.output_dir}")
         if not MODAL_AVAILABLE:
             print("ManimRenderer is in a non-functional state as the Modal backend is not available.")
@@ -70,46 +83,83 @@ class ManimRenderer:
 
         # --- Local Cache Check ---
         # Generate a unique filename based on a hash of the scene code.
-        # This allows us to avoid re-rendering identical scenes.
-        content_hash = hashlib.md5(scene_code.encode('utf-8')).hexdigest()
+        # This allows us to avoid re-rendering identical scenes. blake2b is
+        # considerably faster than MD5 in CPython for code-sized inputs.
+        content_hash = hashlib.blake2b(scene_code.encode('utf-8'), digest_size=16).hexdigest()
         # The scene name is fixed in the Modal runner template
         scene_name = "GeneratedScene"
         output_filename = f"{scene_name}_{content_hash}.mp4"
         local_cache_path = self.output_dir / output_filename
 
-        if local_cache_path.exists():
+        cached_path = self._path_cache.get(content_hash)
+        if cached_path is not None:
+            return cached_path
+
+        # stat through a worker thread so the event loop never blocks on disk
+        if await asyncio.to_thread(local_cache_path.exists):
             print(f"Manim video found in local cache: {local_cache_path}")
             # Return path relative to the `runtime/cache` directory
-            return str(Path("manim") / local_cache_path.name)
+            relative_path = str(Path("manim") / local_cache_path.name)
+            self._path_cache[content_hash] = relative_path
+            return relative_path
+
+        # --- In-flight Deduplication ---
+        # If another request is already rendering this exact scene, wait for
+        # its result instead of launching a duplicate remote render.
+        existing = self._inflight.get(content_hash)
+        if existing is not None:
+            print(f"Awaiting in-flight Manim render for hash {content_hash}.")
+            return await existing
+        future: asyncio.Future = asyncio.get_running_loop().create_future()
+        self._inflight[content_hash] = future
 
         # --- Remote Rendering Call ---
         try:
             print("Calling remote Modal function for Manim rendering...")
-            
-            # .remote.aio() is the non-blocking, async version of the call.
-            video_bytes = await render_manim_scene_modal.remote.aio(scene_code)
-            
-            if not video_bytes:
-                raise Exception("Modal function returned empty video data.")
 
-            # --- Save to Local Cache ---
-            # Save the received video bytes to our local cache for future requests.
-            with open(local_cache_path, "wb") as f:
-                f.write(video_bytes)
+            # --- Stream to Local Cache ---
+            # The remote function yields the video in chunks; write them
+            # straight to disk (via a worker thread, so the event loop never
+            # blocks) instead of buffering the whole file in memory. The
+            # write targets a .part file so a failed transfer can never be
+            # mistaken for a cached video by the exists() check above.
+            partial_path = local_cache_path.with_suffix(".part")
+            total_bytes = 0
+            video_file = await asyncio.to_thread(partial_path.open, "wb")
+            try:
+                async for chunk in render_manim_scene_modal.remote_gen.aio(scene_code):
+                    total_bytes += len(chunk)
+                    await asyncio.to_thread(video_file.write, chunk)
+            finally:
+                await asyncio.to_thread(video_file.close)
+
+            if total_bytes == 0:
+                await asyncio.to_thread(partial_path.unlink)
+                raise Exception("Modal function returned empty video data.")
+            await asyncio.to_thread(partial_path.replace, local_cache_path)
             
             print(f"Manim video received from Modal and saved to local cache: {local_cache_path}")
             
             # --- Return Relative Path ---
             # The path should be relative to `runtime/cache` for the Gradio static server.
-            relative_path = Path("manim") / local_cache_path.name
-            return str(relative_path)
+            relative_path = str(Path("manim") / local_cache_path.name)
+            self._path_cache[content_hash] = relative_path
+            future.set_result(relative_path)
+            return relative_path
 
         except modal.exception.RemoteError as e:
             # This error specifically catches exceptions raised *within* the remote Modal function.
             print(f"Error from remote Manim renderer: {e}")
             # Propagate a user-friendly error message.
-            raise Exception(f"Failed to render Manim video remotely. The scene code may contain an error. Details: {e}")
+            error = Exception(f"Failed to render Manim video remotely. The scene code may contain an error. Details: {e}")
+            future.set_exception(error)
+            raise error
         except Exception as e:
             # Catch other potential errors (network issues, etc.)
             print(f"An unexpected error occurred while calling the Modal Manim renderer: {e}")
-            raise
\ No newline at end of file
+            future.set_exception(e)
+            raise
+        finally:
+            # Waiters already hold the future; new requests start fresh (or
+            # hit the local cache on success).
+            self._inflight.pop(content_hash, None)
\ No newline at end of file
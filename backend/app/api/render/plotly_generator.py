@@ -2,14 +2,40 @@ import plotly.graph_objects as go
 import numpy as np
 from typing import Dict, Any
 from asteval import Interpreter 
+from cachetools import LRUCache
 from backend.app.models.context import VisualizationSpec
 
+# sympy is optional: with it, expressions are compiled once via lambdify and
+# evaluated as a vectorized NumPy call instead of asteval's per-node Python
+# dispatch over the 400-point array. Without it the asteval path still works.
+try:
+    import sympy
+    SYMPY_AVAILABLE = True
+except ImportError:
+    sympy = None
+    SYMPY_AVAILABLE = False
+
+# Compiled callables keyed by (expression, parameter names); repeat parameter
+# tweaks on the same expression skip parsing and codegen entirely.
+_LAMBDIFY_CACHE: LRUCache = LRUCache(maxsize=256)
+
+# Parsed asteval ASTs keyed by expression, for the fallback path: the
+# tokenize/ast.parse step dominates short-expression latency, and the parsed
+# tree can be re-run against a fresh symbol table on every request.
+_ASTEVAL_AST_CACHE: LRUCache = LRUCache(maxsize=256)
+
+
 class PlotlyGenerator:
     """
     Generates Plotly figures from a structured specification.
     """
     def __init__(self):
         print("PlotlyGenerator initialized.")
+        # The plot domain is fixed, so the x array is allocated once and
+        # shared read-only across requests. float32 is plenty for a curve
+        # rendered at canvas resolution and halves the encoded payload.
+        self._x_values = np.linspace(-10, 10, 400, dtype=np.float32)
+        self._x_values.setflags(write=False)
         # Create a safe interpreter for evaluating math expressions
         self.safe_interpreter = Interpreter()
         # Add common math functions and constants to the interpreter's symbol table
@@ -55,16 +81,35 @@ class PlotlyGenerator:
             try:
                 # Get parameters and their default values from the spec
                 parameters = content.get("parameters", {})
-                for param_name, config in parameters.items():
-                    # Add parameter default values to the interpreter's symbol table
-                    self.safe_interpreter.symtable[param_name] = config.get("default", 0)
-
-                # Generate x values
-                x_values = np.linspace(-10, 10, 400)
-                self.safe_interpreter.symtable['x'] = x_values
 
-                # Safely evaluate the expression
-                y_values = self.safe_interpreter.eval(function_expr)
+                x_values = self._x_values
+
+                y_values = None
+                if SYMPY_AVAILABLE:
+                    # Fast path: compile once, evaluate the whole array in a
+                    # single vectorized call. Falls through to asteval for
+                    # expressions sympify cannot parse (e.g. np.sin(x)).
+                    try:
+                        fn = self._compiled_function(function_expr, tuple(parameters.keys()))
+                        y_values = fn(x_values, *(config.get("default", 0) for config in parameters.values()))
+                        # Constant expressions evaluate to a scalar; keep
+                        # the output float32 like the x array.
+                        y_values = np.broadcast_to(np.asarray(y_values, dtype=np.float32), x_values.shape)
+                    except Exception:
+                        y_values = None
+
+                if y_values is None:
+                    for param_name, config in parameters.items():
+                        # Add parameter default values to the interpreter's symbol table
+                        self.safe_interpreter.symtable[param_name] = config.get("default", 0)
+                    self.safe_interpreter.symtable['x'] = x_values
+                    # Safely evaluate the expression; the parse is cached so
+                    # repeat requests only pay for the run step.
+                    parsed = _ASTEVAL_AST_CACHE.get(function_expr)
+                    if parsed is None:
+                        parsed = self.safe_interpreter.parse(function_expr)
+                        _ASTEVAL_AST_CACHE[function_expr] = parsed
+                    y_values = np.asarray(self.safe_interpreter.run(parsed), dtype=np.float32)
 
                 # Create the plot
                 fig = go.Figure(data=go.Scatter(x=x_values, y=y_values, mode='lines', name=function_expr))
@@ -89,6 +134,18 @@ class PlotlyGenerator:
         return self._create_error_figure(error_message)
 
 
+    @staticmethod
+    def _compiled_function(function_expr: str, param_names: tuple):
+        """Returns a cached, lambdified callable for (expression, parameters)."""
+        key = (function_expr, param_names)
+        fn = _LAMBDIFY_CACHE.get(key)
+        if fn is None:
+            parsed = sympy.sympify(function_expr)
+            args = [sympy.Symbol('x'), *(sympy.Symbol(name) for name in param_names)]
+            fn = sympy.lambdify(args, parsed, modules='numpy')
+            _LAMBDIFY_CACHE[key] = fn
+        return fn
+
     def _create_error_figure(self, error_message: str) -> go.Figure:
         """Creates an empty Plotly figure with an error message annotation."""
         fig = go.Figure()
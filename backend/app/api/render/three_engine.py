@@ -1,16 +1,21 @@
+import asyncio
 import hashlib
+import logging
+import string
 from pathlib import Path
 from typing import Dict, Any
 from backend.app.models.context import VisualizationSpec
+# Shared with the interactive-JS generator: both emit HTML into the same
+# cache directory and key by a blake2b spec hash, so one in-memory tier
+# serves both.
+from backend.app.api.render.js_generator import _INFLIGHT, _PATH_CACHE
 
-class ThreeJSGenerator:
-    """
-    Generates a self-contained, interactive 3D scene using Three.js.
-    The output is an HTML file that can be embedded in an iframe.
-    """
-    def __init__(self):
-        # This includes the library, a basic scene setup, and an animation loop.
-        self.base_html_template = """
+logger = logging.getLogger(__name__)
+
+# Parsed once at import time: string.Template.substitute is a single
+# compiled-regex pass, instead of str.format re-parsing the multi-KB
+# template (and re-unescaping every doubled brace) per call.
+_BASE_HTML_TEMPLATE = string.Template("""
 <!DOCTYPE html>
 <html>
 <head>
@@ -18,24 +23,25 @@ class ThreeJSGenerator:
     <meta name="viewport" content="width=device-width, initial-scale=1.0">
     <title>3D Visualization</title>
     <style>
-        body {{ margin: 0; overflow: hidden; }}
-        canvas {{ display: block; width: 100%; height: 100%; }}
+        body { margin: 0; overflow: hidden; }
+        canvas { display: block; width: 100%; height: 100%; }
     </style>
 </head>
 <body>
     <!-- Import Three.js and OrbitControls -->
     <script type="importmap">
-    {{
-        "imports": {{
+    {
+        "imports": {
             "three": "https://unpkg.com/three@0.160.0/build/three.module.js",
             "three/addons/": "https://unpkg.com/three@0.160.0/examples/jsm/"
-        }}
-    }}
+        }
+    }
     </script>
 
     <script type="module">
         import * as THREE from 'three';
-        import {{ OrbitControls }} from 'three/addons/controls/OrbitControls.js';
+        import { OrbitControls } from 'three/addons/controls/OrbitControls.js';
+        import * as BufferGeometryUtils from 'three/addons/utils/BufferGeometryUtils.js';
 
         // --- Basic Scene Setup ---
         const scene = new THREE.Scene();
@@ -44,7 +50,7 @@ class ThreeJSGenerator:
         const camera = new THREE.PerspectiveCamera(75, window.innerWidth / window.innerHeight, 0.1, 1000);
         camera.position.z = 5;
 
-        const renderer = new THREE.WebGLRenderer({{ antialias: true }});
+        const renderer = new THREE.WebGLRenderer({ antialias: true });
         renderer.setSize(window.innerWidth, window.innerHeight);
         document.body.appendChild(renderer.domElement);
 
@@ -70,38 +76,82 @@ class ThreeJSGenerator:
         // --- LLM GENERATED SCENE SETUP CODE START ---
         // This is where the LLM's custom JavaScript code will be injected.
         // It should add objects to the 'scene' and can define animation logic.
-        {injected_scene_code}
+        // Static meshes that share a material can be pushed onto
+        // window.__staticMeshes to be merged into a single draw call below.
+        window.__staticMeshes = [];
+        ${injected_scene_code}
         // --- LLM GENERATED SCENE SETUP CODE END ---
+
+        // --- Static Batching ---
+        // Many small static meshes cost one draw call each; merging their
+        // geometries collapses them into one.
+        if (window.__staticMeshes.length > 1) {
+            try {
+                const merged = BufferGeometryUtils.mergeGeometries(
+                    window.__staticMeshes.map(m => {
+                        m.updateMatrixWorld(true);
+                        return m.geometry.clone().applyMatrix4(m.matrixWorld);
+                    })
+                );
+                scene.add(new THREE.Mesh(merged, window.__staticMeshes[0].material));
+                window.__staticMeshes.forEach(m => scene.remove(m));
+            } catch (e) {
+                // Incompatible geometries (mismatched attributes) stay unmerged
+                console.warn('Static batching skipped:', e);
+            }
+        }
         
-        // --- Animation Loop ---
-        function animate() {{
+        // --- Animation Loop (rendering on demand) ---
+        // The scene only re-renders when something changed: camera movement,
+        // a resize, or injected animation code calling requestRender().
+        // An idle scene costs ~0% GPU instead of rendering at 60 Hz forever.
+        let needsRender = true;
+        function requestRender() { needsRender = true; }
+        controls.addEventListener('change', requestRender);
+
+        function animate() {
             requestAnimationFrame(animate);
 
-            // Update controls
+            // Update controls (damping needs per-frame updates)
             controls.update();
 
             // --- LLM GENERATED ANIMATION CODE START ---
-            // Optional: LLM can provide code to be run inside the animation loop.
-            {injected_animation_code}
+            // Optional: LLM can provide code to be run inside the animation
+            // loop. Continuous animations should call requestRender().
+            ${injected_animation_code}
             // --- LLM GENERATED ANIMATION CODE END ---
 
-            renderer.render(scene, camera);
-        }}
+            if (needsRender) {
+                renderer.render(scene, camera);
+                needsRender = false;
+            }
+        }
 
         // --- Handle window resizing ---
-        window.addEventListener('resize', () => {{
+        window.addEventListener('resize', () => {
             camera.aspect = window.innerWidth / window.innerHeight;
             camera.updateProjectionMatrix();
             renderer.setSize(window.innerWidth, window.innerHeight);
-        }});
+            requestRender();
+        });
         
         // Start the animation loop
         animate();
     </script>
 </body>
 </html>
-"""
-        print("ThreeJSGenerator initialized.")
+""")
+
+
+class ThreeJSGenerator:
+    """
+    Generates a self-contained, interactive 3D scene using Three.js.
+    The output is an HTML file that can be embedded in an iframe.
+    """
+    def __init__(self):
+        # The template and path cache live at module scope, so instances are
+        # stateless and interchangeable.
+        logger.info("ThreeJSGenerator initialized.")
 
     async def generate_3d_visualization(self, spec: VisualizationSpec) -> Dict[str, str]:
         """
@@ -122,28 +172,54 @@ class ThreeJSGenerator:
         # The LLM can also provide code for the animation loop
         animation_code = content.get("animation_code", "// No custom animation code provided.")
 
+        # --- Cache Check (before any template work) ---
+        # Key on the spec inputs, not the rendered page: a hit skips the
+        # template substitution entirely and hashes far fewer bytes.
+        key_blob = f"{scene_setup_code}\0{animation_code}".encode('utf-8')
+        file_hash = hashlib.blake2b(key_blob, digest_size=16).hexdigest()
+        cached_path = _PATH_CACHE.get(file_hash)
+        if cached_path is not None:
+            return {"html_path": cached_path}
+
+        # Single-flight: concurrent requests for the same spec await the
+        # first generation instead of racing to write the same file.
+        existing = _INFLIGHT.get(file_hash)
+        if existing is not None:
+            return {"html_path": await existing}
+        future: asyncio.Future = asyncio.get_running_loop().create_future()
+        _INFLIGHT[file_hash] = future
+        try:
+            result = await self._generate_uncached(scene_setup_code, animation_code, file_hash)
+            future.set_result(result)
+            return {"html_path": result}
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            _INFLIGHT.pop(file_hash, None)
+
+    async def _generate_uncached(self, scene_setup_code: str, animation_code: str, file_hash: str) -> str:
+        """Builds (or finds on disk) the HTML for a spec; returns its relative path."""
+        temp_dir = Path("runtime/cache/generated_assets/html")
+        temp_dir.mkdir(parents=True, exist_ok=True)
+        file_path = temp_dir / f"viz_3d_{file_hash}.html"
+        relative_path = Path("generated_assets/html") / file_path.name
+        # stat through a worker thread so the event loop never blocks on disk
+        if await asyncio.to_thread(file_path.exists):
+            logger.debug("3D HTML found in cache: %s", file_path)
+            _PATH_CACHE[file_hash] = str(relative_path)
+            return str(relative_path)
+
         # --- Assemble the final HTML file content ---
-        full_html = self.base_html_template.format(
+        full_html = _BASE_HTML_TEMPLATE.substitute(
             injected_scene_code=scene_setup_code,
             injected_animation_code=animation_code
         )
 
         # --- Save the HTML to a file and return its path ---
-        temp_dir = Path("runtime/cache/generated_assets/html")
-        temp_dir.mkdir(parents=True, exist_ok=True)
-
-        # Create a unique filename based on the hash of the generated content
-        file_hash = hashlib.md5(full_html.encode()).hexdigest()
-        file_path = temp_dir / f"viz_3d_{file_hash}.html"
-
-        # Write to file only if it doesn't already exist (caching)
-        if not file_path.exists():
-             file_path.write_text(full_html, encoding='utf-8')
-             print(f"Generated and saved new 3D HTML to: {file_path}")
-        else:
-             print(f"3D HTML found in cache: {file_path}")
+        await asyncio.to_thread(file_path.write_text, full_html, 'utf-8')
+        logger.debug("Generated and saved new 3D HTML to: %s", file_path)
+        _PATH_CACHE[file_hash] = str(relative_path)
 
         # Return the path relative to the static mount point (`runtime/cache`)
-        relative_path = Path("generated_assets/html") / file_path.name
-
-        return {"html_path": str(relative_path)}
\ No newline at end of file
+        return str(relative_path)
\ No newline at end of file
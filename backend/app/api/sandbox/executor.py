@@ -1,61 +1,170 @@
-import subprocess
-import tempfile
+import asyncio
+import ast
+import json
 import os
-from typing import Dict, Any
+import sys
+from pathlib import Path
+from typing import Dict, Any, Optional
+
+# The worker script lives next to this module and is run with the same
+# interpreter that runs the app.
+_WORKER_SCRIPT = Path(__file__).parent / "sandbox_worker.py"
+
+# Modules that sandboxed code may not import, and names it may not call.
+# Enforced on the parse tree rather than by substring matching, so string
+# literals and obfuscated spellings don't produce false negatives/positives.
+_FORBIDDEN_MODULES = {
+    "os", "sys", "subprocess", "shutil", "socket", "ctypes",
+    "importlib", "pathlib", "builtins",
+}
+_FORBIDDEN_CALLS = {
+    "eval", "exec", "open", "__import__", "input", "compile",
+    "getattr", "setattr", "delattr", "globals", "locals", "vars",
+}
+
+
+class _Validator(ast.NodeVisitor):
+    """Rejects imports of forbidden modules and calls to forbidden names."""
+
+    def visit_Import(self, node):
+        for alias in node.names:
+            if alias.name.split(".")[0] in _FORBIDDEN_MODULES:
+                raise ValueError(f"import of '{alias.name}' is not allowed")
+        self.generic_visit(node)
+
+    def visit_ImportFrom(self, node):
+        if node.module and node.module.split(".")[0] in _FORBIDDEN_MODULES:
+            raise ValueError(f"import from '{node.module}' is not allowed")
+        self.generic_visit(node)
+
+    def visit_Call(self, node):
+        if isinstance(node.func, ast.Name) and node.func.id in _FORBIDDEN_CALLS:
+            raise ValueError(f"call to '{node.func.id}' is not allowed")
+        self.generic_visit(node)
+
+    def visit_Attribute(self, node):
+        # Block the usual dunder escape hatches (obj.__class__, __globals__…)
+        if node.attr.startswith("__") and node.attr.endswith("__"):
+            raise ValueError(f"access to '{node.attr}' is not allowed")
+        self.generic_visit(node)
+
+
+class _SandboxWorker:
+    """
+    Handle for one long-lived sandbox process. Requests and responses are
+    length-prefixed frames over stdin/stdout (see sandbox_worker.py).
+    """
+
+    def __init__(self, proc: asyncio.subprocess.Process):
+        self.proc = proc
+
+    @classmethod
+    async def spawn(cls) -> "_SandboxWorker":
+        # close_fds=False keeps CPython on the constant-time posix_spawn()
+        # path; the default forces fork()+exec(), which copies the page
+        # tables of this (numpy-laden) backend process on every spawn.
+        # -I runs the worker isolated (no PYTHONPATH, no user site, no
+        # script-dir on sys.path), matching the sandbox intent.
+        proc = await asyncio.create_subprocess_exec(
+            sys.executable, "-I", "-u", str(_WORKER_SCRIPT),
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL,
+            close_fds=False,
+        )
+        return cls(proc)
+
+    async def run(self, code: str) -> Dict[str, Any]:
+        payload = code.encode("utf-8")
+        self.proc.stdin.write(len(payload).to_bytes(4, "big") + payload)
+        await self.proc.stdin.drain()
+        header = await self.proc.stdout.readexactly(4)
+        length = int.from_bytes(header, "big")
+        return json.loads(await self.proc.stdout.readexactly(length))
+
+    async def kill(self):
+        try:
+            self.proc.kill()
+        except ProcessLookupError:
+            pass
+        await self.proc.wait()
+
 
 class SafeCodeExecutor:
     def __init__(self):
         self.allowed_imports = {
             'math', 'numpy', 'matplotlib', 'plotly', 'd3'
         }
-        self.forbidden_patterns = [
-            'import os', 'import sys', 'subprocess', 'eval', 'exec',
-            '__import__', 'open(', 'file(', 'input(', 'raw_input('
-        ]
-    
+        # Persistent worker pool: each worker is a long-lived interpreter
+        # that has already paid startup and numpy import, so an execution
+        # costs a pipe round trip instead of a fork+exec (~100ms). Workers
+        # are spawned lazily up to the CPU count, which also bounds how many
+        # sandboxed executions run concurrently.
+        self._pool_size = os.cpu_count() or 2
+        self._idle: asyncio.Queue = asyncio.Queue()
+        self._spawned = 0
+        self._spawn_lock = asyncio.Lock()
+
     def validate_code(self, code: str) -> bool:
         """Validate that code is safe to execute"""
-        for pattern in self.forbidden_patterns:
-            if pattern in code.lower():
-                return False
+        # One C-level parse plus a tree walk, instead of repeated substring
+        # scans over the lowercased source — faster on multi-KB snippets and
+        # not fooled by string literals or creative spellings.
+        try:
+            _Validator().visit(ast.parse(code))
+        except (SyntaxError, ValueError):
+            return False
         return True
-    
+
+    async def _acquire_worker(self) -> _SandboxWorker:
+        """Returns an idle worker, spawning one if the pool is not full yet."""
+        if not self._idle.empty():
+            return self._idle.get_nowait()
+        async with self._spawn_lock:
+            if self._spawned < self._pool_size:
+                self._spawned += 1
+                try:
+                    return await _SandboxWorker.spawn()
+                except Exception:
+                    self._spawned -= 1
+                    raise
+        # Pool is at capacity: wait for a worker to come back
+        return await self._idle.get()
+
+    async def _discard_worker(self, worker: _SandboxWorker):
+        """Kills a broken/timed-out worker; a replacement spawns on demand."""
+        await worker.kill()
+        self._spawned -= 1
+
     async def execute_python_safe(self, code: str) -> Dict[str, Any]:
         """Execute Python code in sandboxed environment"""
         if not self.validate_code(code):
             raise ValueError("Code contains forbidden patterns")
-        
-        with tempfile.NamedTemporaryFile(mode='w', suffix='.py', delete=False) as f:
-            f.write(code)
-            temp_file = f.name
-        
+
+        worker: Optional[_SandboxWorker] = await self._acquire_worker()
         try:
-            # Run in restricted environment
-            result = subprocess.run([
-                'python', '-c', f'''
-import sys
-import builtins
-import math
-import numpy as np
-
-# Restrict builtins
-builtins.__dict__.clear()
-builtins.__dict__.update({{
-    'print': print,
-    'len': len,
-    'range': range,
-    'math': math,
-    'np': np
-}})
-
-exec(open("{temp_file}").read())
-                '''
-            ], capture_output=True, text=True, timeout=10)
-            
+            result = await asyncio.wait_for(worker.run(code), timeout=10)
+        except asyncio.TimeoutError:
+            # The worker is still running the code: kill it rather than
+            # letting a runaway execution occupy a pool slot.
+            await self._discard_worker(worker)
+            worker = None
             return {
-                "success": result.returncode == 0,
-                "output": result.stdout,
-                "error": result.stderr
+                "success": False,
+                "output": "",
+                "error": "Execution timed out after 10 seconds"
+            }
+        except Exception as e:
+            # Broken pipe / worker crash: drop it and surface the failure
+            await self._discard_worker(worker)
+            worker = None
+            return {
+                "success": False,
+                "output": "",
+                "error": f"Sandbox worker failed: {e}"
             }
         finally:
-            os.unlink(temp_file)
\ No newline at end of file
+            if worker is not None:
+                self._idle.put_nowait(worker)
+
+        return result
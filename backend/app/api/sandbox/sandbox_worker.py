@@ -0,0 +1,86 @@
+"""
+Long-lived sandbox worker process.
+
+Spawned by SafeCodeExecutor with `python -u sandbox_worker.py`; loops reading
+length-prefixed code frames from stdin, executes each one in a restricted
+namespace, and writes the result back to stdout as a length-prefixed JSON
+frame. Keeping the interpreter (and the numpy import) alive across requests
+is the whole point: per-execution cost drops from interpreter startup to a
+pipe round trip.
+
+Frame format, both directions: 4-byte big-endian payload length + UTF-8
+payload. The request payload is the code to run; the response payload is
+JSON with 'success', 'output' and 'error' keys.
+"""
+import contextlib
+import io
+import json
+import math
+import sys
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+_STDIN = sys.stdin.buffer
+_STDOUT = sys.stdout.buffer
+
+# Mirror of the restricted environment the per-request subprocess used to
+# build: a handful of safe builtins plus math/numpy.
+_SAFE_BUILTINS = {
+    "print": print,
+    "len": len,
+    "range": range,
+    "abs": abs,
+    "min": min,
+    "max": max,
+    "sum": sum,
+    "round": round,
+}
+
+
+def _read_exactly(count: int) -> bytes:
+    """Reads exactly `count` bytes from stdin, or b'' on EOF."""
+    data = b""
+    while len(data) < count:
+        chunk = _STDIN.read(count - len(data))
+        if not chunk:
+            return b""
+        data += chunk
+    return data
+
+
+def _run(code: str) -> dict:
+    """Executes one code frame in a fresh restricted namespace."""
+    captured = io.StringIO()
+    error = ""
+    success = True
+    namespace = {
+        "__builtins__": dict(_SAFE_BUILTINS),
+        "math": math,
+        "np": np,
+    }
+    try:
+        with contextlib.redirect_stdout(captured):
+            exec(code, namespace)
+    except BaseException as e:
+        success = False
+        error = f"{type(e).__name__}: {e}"
+    return {"success": success, "output": captured.getvalue(), "error": error}
+
+
+def main():
+    while True:
+        header = _read_exactly(4)
+        if not header:
+            break  # parent closed the pipe; exit cleanly
+        length = int.from_bytes(header, "big")
+        code = _read_exactly(length).decode("utf-8")
+        payload = json.dumps(_run(code)).encode("utf-8")
+        _STDOUT.write(len(payload).to_bytes(4, "big") + payload)
+        _STDOUT.flush()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,297 @@
+import asyncio
+import hashlib
+import logging
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+from cachetools import LRUCache
+
+from backend.app.api.context.memory import get_connection_pool
+from backend.app.core.fastjson import json_dumps, json_loads
+from backend.app.models.context import VisualizationSpec
+
+logger = logging.getLogger(__name__)
+
+# The embedding model is an optional dependency: without it the cache simply
+# stays disabled and every request goes to the LLM as before.
+try:
+    from sentence_transformers import SentenceTransformer
+    SENTENCE_TRANSFORMERS_AVAILABLE = True
+except ImportError:
+    SentenceTransformer = None
+    SENTENCE_TRANSFORMERS_AVAILABLE = False
+    logger.warning("sentence-transformers not installed. "
+                   "Semantic response caching is disabled.")
+
+# SQL statement to create the semantic cache table.
+# Embeddings are persisted as raw float32 BLOBs so the index survives restarts.
+CREATE_SEMANTIC_CACHE_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS semantic_cache (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    message TEXT NOT NULL,
+    embedding BLOB NOT NULL,   -- L2-normalized float32 vector
+    response TEXT NOT NULL,    -- JSON of the cached chat response payload
+    created_at TEXT DEFAULT CURRENT_TIMESTAMP
+);
+"""
+
+
+class RenderCache:
+    """
+    Cache of rendered visualization payloads keyed by a hash of the spec.
+    Identical VisualizationSpecs (common when users iterate on a widget and
+    come back to an earlier variant) skip the renderer entirely — for Manim
+    that turns a multi-second remote render into a dictionary lookup.
+
+    Entries are small JSON files under runtime/cache/render_cache/ so hits
+    survive restarts, fronted by a bounded in-memory LRU map.
+    """
+    def __init__(self, cache_dir: str = "runtime/cache/render_cache", maxsize: int = 256):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self._lru: LRUCache = LRUCache(maxsize=maxsize)
+        logger.info("RenderCache initialized at %s.", self.cache_dir)
+
+    @staticmethod
+    def spec_key(spec: VisualizationSpec) -> str:
+        """Content hash identifying a spec (field order is deterministic)."""
+        return hashlib.sha256(spec.model_dump_json().encode("utf-8")).hexdigest()
+
+    def _payload_valid(self, payload: Dict[str, Any]) -> bool:
+        """
+        URL-type payloads point at files under the static root, and generated
+        HTML lives on a tmpfs in deployment — a persisted cache entry can
+        outlive its target across restarts. Serving it would hand the client
+        a broken iframe with no regeneration path, so check the file first.
+        """
+        url = payload.get("url")
+        if not url or not url.startswith("/static/"):
+            return True
+        # cache_dir is <static root>/render_cache; URLs are served from the
+        # static root.
+        return (self.cache_dir.parent / url[len("/static/"):]).exists()
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """Returns the cached visualization payload for a spec hash, if any."""
+        payload = self._lru.get(key)
+        if payload is not None:
+            if self._payload_valid(payload):
+                return payload
+            self._evict(key)
+            return None
+
+        entry_path = self.cache_dir / f"{key}.json"
+        if entry_path.exists():
+            try:
+                payload = json_loads(entry_path.read_text(encoding="utf-8"))
+            except Exception as e:
+                logger.warning("Skipping corrupted render cache entry %s: %s", entry_path.name, e)
+                return None
+            if not self._payload_valid(payload):
+                self._evict(key)
+                return None
+            self._lru[key] = payload
+            return payload
+        return None
+
+    def _evict(self, key: str):
+        """Drops a stale entry so the next request re-renders and re-caches."""
+        self._lru.pop(key, None)
+        try:
+            (self.cache_dir / f"{key}.json").unlink(missing_ok=True)
+        except OSError as e:
+            logger.warning("Failed to drop stale render cache entry %s: %s", key, e)
+
+    def put(self, key: str, payload: Dict[str, Any]):
+        """Stores a visualization payload under a spec hash."""
+        self._lru[key] = payload
+        entry_path = self.cache_dir / f"{key}.json"
+        try:
+            entry_path.write_text(json_dumps(payload), encoding="utf-8")
+        except Exception as e:
+            logger.warning("Failed to persist render cache entry %s: %s", entry_path.name, e)
+
+
+class SemanticCache:
+    """
+    Embedding-based response cache for chat turns. Near-duplicate requests
+    ("plot sin(x)", "graph sin x") hit the same cached response, skipping
+    both the LLM round trip and the renderer.
+
+    Lookups embed the incoming message locally (MiniLM, a few ms), then take
+    the maximum cosine similarity against all cached entries via a single
+    matrix product — equivalent to a FAISS IndexFlatIP for the cache sizes
+    this app sees, without the extra dependency.
+    """
+    # How many trailing history messages are folded into the embedded text.
+    # Follow-ups like "tell me more" only match a cached entry that was
+    # stored under the same recent conversation, not an unrelated session's.
+    CONTEXT_WINDOW = 4
+
+    def __init__(
+        self,
+        model_name: str = "all-MiniLM-L6-v2",
+        similarity_threshold: float = 0.95,
+        static_root: str = "runtime/cache",
+    ):
+        self.similarity_threshold = similarity_threshold
+        self.enabled = SENTENCE_TRANSFORMERS_AVAILABLE
+        self._model = None
+        self._model_name = model_name
+        # Root the '/static' mount serves from; used to verify that cached
+        # visualization URLs still point at existing files.
+        self.static_root = Path(static_root)
+        # In-memory mirror of the persisted cache: a (n, d) matrix of
+        # normalized embeddings and the parallel lists of response payloads
+        # and their SQLite row ids (for deleting stale entries).
+        self._embeddings: Optional[np.ndarray] = None
+        self._responses: List[Dict[str, Any]] = []
+        self._row_ids: List[int] = []
+        self._loaded = False
+        if self.enabled:
+            logger.info("SemanticCache initialized (model: %s, threshold: %s).", model_name, similarity_threshold)
+
+    def _cache_text(self, message: str, context_messages: Optional[List[Dict[str, str]]] = None) -> str:
+        """Builds the text that is embedded: recent history tail + message."""
+        if not context_messages:
+            return message
+        tail = context_messages[-self.CONTEXT_WINDOW:]
+        lines = [f"{m['role']}: {m['content']}" for m in tail]
+        lines.append(message)
+        return "\n".join(lines)
+
+    def _embed_sync(self, text: str) -> np.ndarray:
+        """Embeds and L2-normalizes a message (lazy-loads the model)."""
+        if self._model is None:
+            self._model = SentenceTransformer(self._model_name)
+        vector = self._model.encode([text])[0].astype(np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+
+    async def _embed(self, text: str) -> np.ndarray:
+        """
+        Runs the embedding off the event loop: the first call loads the
+        SentenceTransformer model (seconds) and every call runs encode()
+        (milliseconds of pure CPU) — both would stall concurrent requests
+        if run inline.
+        """
+        return await asyncio.to_thread(self._embed_sync, text)
+
+    async def _ensure_loaded(self):
+        """Loads persisted cache entries from SQLite on first use."""
+        if self._loaded:
+            return
+        pool = get_connection_pool()
+        async with pool.connection() as db:
+            await db.execute(CREATE_SEMANTIC_CACHE_TABLE_SQL)
+            await db.commit()
+            cursor = await db.execute("SELECT id, embedding, response FROM semantic_cache ORDER BY id")
+            rows = await cursor.fetchall()
+            await cursor.close()
+
+        embeddings = []
+        for row_id, embedding_blob, response_json in rows:
+            try:
+                response = json_loads(response_json)
+                embeddings.append(np.frombuffer(embedding_blob, dtype=np.float32))
+                self._responses.append(response)
+                self._row_ids.append(row_id)
+            except Exception as e:
+                logger.warning("Skipping corrupted semantic cache entry: %s", e)
+        if embeddings:
+            self._embeddings = np.vstack(embeddings)
+        self._loaded = True
+        logger.info("SemanticCache loaded %d persisted entries.", len(self._responses))
+
+    def _payload_valid(self, response: Dict[str, Any]) -> bool:
+        """
+        Cached responses embed visualization URLs, and the files they point
+        at live on a tmpfs in deployment — entries persisted in SQLite can
+        outlive their targets across restarts. Serving one would hand the
+        client a dead iframe/video with no regeneration path, so check the
+        file before trusting the hit (same rule as RenderCache).
+        """
+        visualization = response.get("visualization")
+        if not isinstance(visualization, dict):
+            return True
+        url = visualization.get("url")
+        if not url or not url.startswith("/static/"):
+            return True
+        return (self.static_root / url[len("/static/"):]).exists()
+
+    async def _evict(self, index: int):
+        """Drops a stale entry from SQLite and the in-memory index."""
+        row_id = self._row_ids.pop(index)
+        del self._responses[index]
+        self._embeddings = np.delete(self._embeddings, index, axis=0)
+        try:
+            pool = get_connection_pool()
+            async with pool.connection() as db:
+                await db.execute("DELETE FROM semantic_cache WHERE id = ?", (row_id,))
+                await db.commit()
+        except Exception as e:
+            logger.warning("Failed to drop stale semantic cache row %s: %s", row_id, e)
+
+    async def lookup(
+        self,
+        message: str,
+        context_messages: Optional[List[Dict[str, str]]] = None,
+    ) -> Optional[Dict[str, Any]]:
+        """
+        Returns the cached response payload for the most similar cached
+        message, or None if nothing exceeds the similarity threshold.
+        When context_messages is given, the recent history tail is embedded
+        together with the message so follow-up turns are matched in context.
+        Hits whose visualization files no longer exist are evicted and the
+        next-best candidate is considered instead.
+        """
+        if not self.enabled:
+            return None
+        await self._ensure_loaded()
+        if self._embeddings is None or len(self._responses) == 0:
+            return None
+
+        query = await self._embed(self._cache_text(message, context_messages))
+        similarities = self._embeddings @ query
+        while similarities.size:
+            best_index = int(np.argmax(similarities))
+            if similarities[best_index] < self.similarity_threshold:
+                return None
+            response = self._responses[best_index]
+            if self._payload_valid(response):
+                logger.debug("SemanticCache hit (similarity: %.3f).", similarities[best_index])
+                return response
+            # Stale: the entry's static target is gone. Evict and fall
+            # through to the next-most-similar candidate.
+            await self._evict(best_index)
+            similarities = np.delete(similarities, best_index)
+        return None
+
+    async def store(
+        self,
+        message: str,
+        response: Dict[str, Any],
+        context_messages: Optional[List[Dict[str, str]]] = None,
+    ):
+        """Persists a response payload and adds it to the in-memory index."""
+        if not self.enabled:
+            return
+        await self._ensure_loaded()
+
+        embedding = await self._embed(self._cache_text(message, context_messages))
+        pool = get_connection_pool()
+        async with pool.connection() as db:
+            cursor = await db.execute(
+                "INSERT INTO semantic_cache (message, embedding, response) VALUES (?, ?, ?)",
+                (message, embedding.tobytes(), json_dumps(response))
+            )
+            await db.commit()
+            row_id = cursor.lastrowid
+
+        self._responses.append(response)
+        self._row_ids.append(row_id)
+        if self._embeddings is None:
+            self._embeddings = embedding[np.newaxis, :]
+        else:
+            self._embeddings = np.vstack([self._embeddings, embedding])
@@ -0,0 +1,21 @@
+"""
+Shared JSON helpers that prefer orjson when it is installed.
+
+orjson is markedly faster than the stdlib json (SIMD UTF-8 validation,
+fewer allocations), which matters on the per-turn hot paths: context
+persistence, prompt building, and cache (de)serialization. The stdlib is
+a drop-in fallback so the optional dependency never becomes a hard one.
+"""
+import json
+from typing import Any
+
+try:
+    import orjson
+
+    def json_dumps(obj: Any) -> str:
+        return orjson.dumps(obj).decode("utf-8")
+
+    json_loads = orjson.loads
+except ImportError:
+    json_dumps = json.dumps
+    json_loads = json.loads
@@ -1,10 +1,61 @@
+import logging
+import logging.handlers
+import queue
+from contextlib import asynccontextmanager
+
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
+import re
+
+# orjson serializes response payloads several times faster than the stdlib
+# encoder; fall back to FastAPI's default JSONResponse when not installed.
+try:
+    from fastapi.responses import ORJSONResponse as _DefaultResponseClass
+except ImportError:
+    from fastapi.responses import JSONResponse as _DefaultResponseClass
 from pathlib import Path
 import os
-from backend.app.main import router as api_router
+from backend.app.api.main import router as api_router
 from backend.app.api.context.memory import initialize_context_storage
+from backend.app.api.llm.http_client import aclose_http_client
+
+# --- Logging Configuration ---
+# Application log records go through an in-memory queue drained by a
+# background listener thread, so the event-loop thread never blocks on
+# stdout writes while holding the GIL.
+_log_queue: "queue.SimpleQueue" = queue.SimpleQueue()
+_log_listener = logging.handlers.QueueListener(
+    _log_queue, logging.StreamHandler(), respect_handler_level=True
+)
+logging.basicConfig(
+    level=logging.INFO,
+    handlers=[logging.handlers.QueueHandler(_log_queue)],
+)
+_log_listener.start()
+
+# --- Application Lifecycle ---
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Startup/shutdown for the application: database initialization before the
+    first request, and cleanup of shared clients on the way down. Replaces
+    the deprecated on_event hooks.
+    """
+    print("FastAPI application starting up...")
+    try:
+        # Initialize the SQLite database and create necessary tables.
+        # This ensures the database is ready before handling any requests.
+        await initialize_context_storage()
+        print("Database context storage initialized successfully.")
+    except Exception as e:
+        print(f"Error during startup initialization: {e}")
+        # Depending on the severity, you might want to exit the application here.
+    yield
+    print("FastAPI application shutting down.")
+    # Close the shared HTTP client used by the LLM providers.
+    await aclose_http_client()
+
 
 # --- FastAPI App Initialization ---
 # Create the main FastAPI application instance.
@@ -14,7 +65,9 @@ app = FastAPI(
     description="Provides services for LLM interaction, context management, and visualization rendering.",
     version="1.0.0",
     docs_url="/docs",
-    redoc_url="/redoc"
+    redoc_url="/redoc",
+    default_response_class=_DefaultResponseClass,
+    lifespan=lifespan,
 )
 
 # --- Middleware Configuration ---
@@ -34,40 +87,29 @@ app.add_middleware(
 static_dir = Path("runtime/cache")
 static_dir.mkdir(parents=True, exist_ok=True)
 
+# Generated assets are content-addressed: a 32-hex digest in the filename
+# (viz_<hash>.html, GeneratedScene_<hash>.mp4, ...) changes whenever the
+# content does, so browsers may cache them forever.
+_HASHED_ASSET_RE = re.compile(r"_[0-9a-f]{32}\.")
+
+
+class CachedStaticFiles(StaticFiles):
+    """StaticFiles that marks content-addressed assets as immutable."""
+
+    async def get_response(self, path: str, scope):
+        response = await super().get_response(path, scope)
+        if response.status_code == 200 and _HASHED_ASSET_RE.search(path):
+            response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+        return response
+
+
 # Mount the 'runtime/cache' directory to be served at the '/static' URL path.
 # This allows the frontend to access generated files like Manim videos and interactive HTML.
 # For example, a file at 'runtime/cache/manim/video.mp4' will be accessible at
 # 'http://<backend_url>/static/manim/video.mp4'.
-app.mount("/static", StaticFiles(directory=static_dir), name="static")
+app.mount("/static", CachedStaticFiles(directory=static_dir), name="static")
 print(f"Serving static files from '{static_dir.resolve()}' at the '/static' route.")
 
-# --- Application Lifecycle Events ---
-@app.on_event("startup")
-async def startup_event():
-    """
-    This function runs once when the FastAPI application starts.
-    It's the ideal place for initialization tasks.
-    """
-    print("FastAPI application starting up...")
-    try:
-        # Initialize the SQLite database and create necessary tables.
-        # This ensures the database is ready before handling any requests.
-        await initialize_context_storage()
-        print("Database context storage initialized successfully.")
-    except Exception as e:
-        print(f"Error during startup initialization: {e}")
-        # Depending on the severity, you might want to exit the application here.
-
-@app.on_event("shutdown")
-def shutdown_event():
-    """
-    This function runs once when the FastAPI application shuts down.
-    Useful for cleanup tasks like closing database connection pools.
-    """
-    print("FastAPI application shutting down.")
-    # Add any cleanup logic here (e.g., closing database connection pools).
-
-
 # --- API Router Inclusion ---
 # Include the main API router from `backend.app.api.main`.
 # All endpoints defined in that router will be added to the application
@@ -1,15 +1,28 @@
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, PrivateAttr
 from typing import Dict, List, Any, Optional
-from datetime import datetime
+import time
 import uuid
 
+# Rolling history window: the in-memory message list (and therefore the
+# prompt and per-turn serialization cost) stays bounded at this many turns;
+# older turns are folded into rolling_summary instead of growing the list.
+MAX_HISTORY_MESSAGES = 40
+# Upper bound on the folded summary text so it cannot grow without limit
+MAX_SUMMARY_CHARS = 4000
+
+
 def create_session_id():
-    return str(uuid.uuid4())
+    # .hex skips the dashed str(UUID) formatting path; called on every new
+    # session and message-less context creation.
+    return uuid.uuid4().hex
 
 class ContextMessage(BaseModel):
     role: str  # "user" | "assistant" | "system"
     content: str
-    timestamp: datetime = Field(default_factory=datetime.now)
+    # Epoch nanoseconds: time.time_ns() is much cheaper than datetime.now()
+    # plus isoformat() on every append, stores as a compact INTEGER, and is
+    # formatted for display only where actually needed.
+    timestamp: int = Field(default_factory=time.time_ns)
     metadata: Optional[Dict[str, Any]] = None
 
 class UIState(BaseModel):
@@ -34,9 +47,35 @@ class LearningContext(BaseModel):
     # Store the *specification* and the *output path*
     last_visualization_spec: Optional[VisualizationSpec] = None
     last_render_output: Optional[str] = None # Path to file (video) or identifier
+    # Condensed text of turns evicted from the bounded message window
+    rolling_summary: Optional[str] = None
+    # Number of leading entries in `messages` already persisted to storage.
+    # Maintained by the storage layer so saves only write the new tail, even
+    # when a long history was loaded truncated.
+    _persisted_messages: int = PrivateAttr(default=0)
 
     def add_message(self, role: str, content: str, metadata: Optional[Dict[str, Any]] = None):
         self.messages.append(ContextMessage(role=role, content=content, metadata=metadata))
+        self._trim_history()
+
+    def _trim_history(self):
+        """
+        Keeps the in-memory window at MAX_HISTORY_MESSAGES by folding the
+        oldest turns into rolling_summary. Evicted rows stay in storage;
+        only the live window (and thus the prompt) is bounded.
+        """
+        overflow = len(self.messages) - MAX_HISTORY_MESSAGES
+        if overflow <= 0:
+            return
+        evicted = self.messages[:overflow]
+        del self.messages[:overflow]
+        # The persisted counter refers to leading entries of the window
+        self._persisted_messages = max(0, self._persisted_messages - overflow)
+
+        folded = " ".join(f"[{m.role}] {m.content}" for m in evicted)
+        summary = f"{self.rolling_summary} {folded}" if self.rolling_summary else folded
+        # Keep the most recent tail when the summary itself overflows
+        self.rolling_summary = summary[-MAX_SUMMARY_CHARS:]
 
     def update_ui_variables(self, variables: Dict[str, Any]):
         self.ui_state.variables.update(variables)
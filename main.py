@@ -1,5 +1,7 @@
+import asyncio
+import logging
 import gradio as gr
-import httpx 
+import httpx
 import uuid
 import json
 import os
@@ -10,99 +12,108 @@ import os
 # In docker-compose, this is set to 'http://backend:8000'.
 # For local testing without Docker, it defaults to 'http://127.0.0.1:8000'.
 BACKEND_URL = os.getenv("BACKEND_URL", "http://127.0.0.1:8000")
+
+logger = logging.getLogger(__name__)
 API_PREFIX = "/api/v1" 
 
-# --- API Client Function ---
-async def send_request_to_backend(session_id: str, message: str) -> dict:
+# One shared client for all backend calls: keep-alive connections skip the
+# per-message TCP (and TLS, when deployed behind HTTPS) handshake that a
+# per-call AsyncClient would redo every turn.
+_client = httpx.AsyncClient(
+    timeout=180.0,
+    limits=httpx.Limits(max_keepalive_connections=20),
+)
+
+async def stream_request_from_backend(session_id: str, message: str):
     """
-    Sends the user's message to the FastAPI backend and returns the parsed JSON response.
-    This function handles all communication with the backend.
+    Calls the backend's streaming chat endpoint and yields parsed SSE events
+    ('delta', 'complete' or 'error' dicts) as they arrive.
     """
-    api_url = f"{BACKEND_URL}{API_PREFIX}/chat/{session_id}"
-    payload = {"message": message, "provider": "openai"}  # The provider could be a UI option later
-
-    print(f"Frontend: Sending request to {api_url}")
+    api_url = f"{BACKEND_URL}{API_PREFIX}/chat/{session_id}/stream"
+    payload = {"message": message, "provider": "openai"}
     try:
-        # Set a generous timeout to allow for LLM and rendering latency.
-        async with httpx.AsyncClient(timeout=180.0) as client:
-            response = await client.post(api_url, json=payload)
-            # This will raise an exception for HTTP error codes (4xx or 5xx).
+        async with _client.stream("POST", api_url, json=payload) as response:
             response.raise_for_status()
-            return response.json()
+            async for line in response.aiter_lines():
+                if line.startswith("data: "):
+                    yield json.loads(line[len("data: "):])
     except httpx.HTTPStatusError as e:
-        # Handle API errors returned from the backend (e.g., 500 Internal Server Error)
-        try:
-            error_detail = e.response.json().get("detail", e.response.text)
-        except json.JSONDecodeError:
-            error_detail = e.response.text
-        print(f"API Error: {e.response.status_code} - {error_detail}")
-        return {"error": f"Backend API Error ({e.response.status_code}): {error_detail}"}
-    except httpx.RequestError as e:
-        # Handle network-level errors (e.g., cannot connect to the backend)
-        error_msg = f"Network Error: Unable to connect to backend at {api_url}. Is the backend server running?"
-        print(f"{error_msg} Details: {e}")
-        return {"error": error_msg}
+        yield {"type": "error", "detail": f"Backend API Error ({e.response.status_code})"}
+    except httpx.RequestError:
+        yield {"type": "error", "detail": f"Network Error: Unable to connect to backend at {api_url}."}
     except Exception as e:
-        print(f"An unexpected error occurred in the API client: {e}")
-        return {"error": f"An unexpected error occurred: {str(e)}"}
+        yield {"type": "error", "detail": f"An unexpected error occurred: {e}"}
 
 # --- Gradio UI and Event Handlers ---
 
-async def handle_user_input(user_message: str, history: list, session_id: str):
+def _build_visualization_updates(visualization: dict | None):
     """
-    The main Gradio event handler. It's triggered by user actions.
-    It calls the backend and then yields updates for the UI components.
+    Maps a backend visualization payload onto the three output components.
+    Uses gr.update(...) dicts rather than rebuilding component instances:
+    updates skip Gradio's component config/validation layer and only the
+    diff goes over the websocket.
     """
-    if not user_message.strip():
-        # Do nothing if the input is empty
-        return
+    html_update = gr.update(visible=False)
+    plot_update = gr.update(visible=False)
+    video_update = gr.update(visible=False)
 
-    # Append user message to the UI immediately for a responsive feel
-    history.append([user_message, None])
-    # Yield the history to update the chatbot with the user's message
-    yield history, gr.update(), gr.update(), gr.update(), gr.update()
-
-    # Call our API client function to get the response from the backend
-    response_data = await send_request_to_backend(session_id, user_message)
-    
-    # Check for an error in the response
-    if "error" in response_data:
-        history[-1][1] = f"⚠️ **Error:** {response_data['error']}"
-        yield history, gr.update(), gr.update(), gr.update(), gr.update()
-        return
-
-    # Process the successful response from the backend
-    explanation = response_data.get("explanation", "*No explanation provided.*")
-    visualization = response_data.get("visualization") # This can be None
-
-    # Update the chatbot with the final text explanation from the assistant
-    history[-1][1] = explanation
-    
-    # Prepare updates for the visualization components
-    html_update = gr.HTML(visible=False)
-    plot_update = gr.Plot(visible=False)
-    video_update = gr.Video(visible=False)
-    
     if visualization:
         viz_type = visualization.get("type")
         if viz_type == "html":
             # Construct the full URL to the static asset served by the backend
             iframe_url = BACKEND_URL + visualization.get("url", "")
-            html_update = gr.HTML(
+            html_update = gr.update(
                 value=f'<iframe src="{iframe_url}" width="100%" height="400px" sandbox="allow-scripts allow-same-origin allow-forms"></iframe>',
                 visible=True
             )
         elif viz_type == "plotly":
             # The backend sends the figure as a JSON string, so we parse it
             figure_json = json.loads(visualization.get("figure", "{}"))
-            plot_update = gr.Plot(value=figure_json, visible=True)
+            plot_update = gr.update(value=figure_json, visible=True)
         elif viz_type == "video":
             # Construct the full URL to the video served by the backend
             video_url = BACKEND_URL + visualization.get("url", "")
-            video_update = gr.Video(value=video_url, visible=True)
+            video_update = gr.update(value=video_url, visible=True)
+
+    return html_update, plot_update, video_update
+
+
+async def handle_user_input(user_message: str, history: list, session_id: str):
+    """
+    The main Gradio event handler. Streams the explanation into the chat as
+    it arrives instead of waiting for the full response. Concurrency across
+    users comes from the queue's default_concurrency_limit: Gradio does not
+    allow generator handlers in batch mode, so events are not batched.
+    """
+    no_change = gr.update()
+    if not user_message.strip():
+        yield history, no_change, no_change, no_change, session_id
+        return
+
+    # Append the user message to the UI immediately for a responsive feel
+    history.append([user_message, None])
+    yield history, no_change, no_change, no_change, session_id
+
+    explanation = ""
+    async for event in stream_request_from_backend(session_id, user_message):
+        if event.get("type") == "delta":
+            explanation += event.get("text", "")
+            history[-1][1] = explanation
+            yield history, no_change, no_change, no_change, session_id
+        elif event.get("type") == "complete":
+            history[-1][1] = event.get("explanation", explanation or "*No explanation provided.*")
+            html_update, plot_update, video_update = _build_visualization_updates(
+                event.get("visualization")
+            )
+            yield history, html_update, plot_update, video_update, session_id
+            return
+        elif event.get("type") == "error":
+            history[-1][1] = f"⚠️ **Error:** {event.get('detail', 'Unknown error')}"
+            yield history, no_change, no_change, no_change, session_id
+            return
+    # Stream ended without a 'complete' event; keep whatever text arrived
+    yield history, no_change, no_change, no_change, session_id
 
-    # Yield the final state with all updates
-    yield history, html_update, plot_update, video_update, session_id
 
 def create_interface():
     """Creates and configures the Gradio Blocks interface."""
@@ -138,26 +149,38 @@ def create_interface():
         send_btn.click(
             fn=handle_user_input,
             inputs=[message_input, chatbot, session_id_state],
-            outputs=outputs
+            outputs=outputs,
         ).then(lambda: "", outputs=message_input) # Clear input after send
 
         message_input.submit(
             fn=handle_user_input,
             inputs=[message_input, chatbot, session_id_state],
-            outputs=outputs
+            outputs=outputs,
         ).then(lambda: "", outputs=message_input)
 
         def clear_chat_handler():
             # Simply clear the UI and generate a new session ID for a fresh start
             new_session_id = str(uuid.uuid4())
-            return [], gr.HTML(visible=False), gr.Plot(visible=False), gr.Video(visible=False), new_session_id
+            return [], gr.update(visible=False), gr.update(visible=False), gr.update(visible=False), new_session_id
 
         clear_btn.click(fn=clear_chat_handler, outputs=outputs)
     return app
 
 # --- Entry Point ---
 if __name__ == "__main__":
+    # Run the event loop on uvloop where available (Linux/macOS): every chat
+    # turn crosses the loop many times (HTTP, streaming, queue), and uvloop
+    # lowers the per-await scheduling overhead.
+    try:
+        import uvloop
+        uvloop.install()
+    except ImportError:
+        pass
+
     interface = create_interface()
+    # Allow several queued events to run concurrently; this is what lets
+    # multiple users' turns overlap now that the handler streams per event.
+    interface.queue(default_concurrency_limit=8)
     # Launch on 0.0.0.0 to be accessible within a Docker container.
     # The port 7860 is what we expose in docker-compose.yml.
     interface.launch(server_name="0.0.0.0", server_port=7860)
\ No newline at end of file
@@ -1,20 +1,123 @@
 import modal
 import asyncio
+import hashlib
+import json
+import os
+import threading
 from typing import Dict, Any, List, Union
 
+# Warm-pool sizing, settable per deployment without code changes. Bump
+# LLM_KEEP_WARM when sustained traffic makes cold starts visible
+# (rule of thumb: ceil(p95 calls-per-minute * avg duration seconds / 60)).
+_KEEP_WARM = int(os.getenv("LLM_KEEP_WARM", "1"))
+_CONCURRENT_INPUTS = int(os.getenv("LLM_CONCURRENT_INPUTS", "10"))
+
+# --- Module-Scope Backend Imports ---
+# Imported once at container build/warm-up rather than inside each function
+# body, so no request pays import machinery or Pydantic schema compilation.
+# Guarded: a bare `modal deploy` client may not have the provider SDKs
+# installed locally, and only needs the decorators, not the bodies.
+try:
+    from backend.app.api.llm.router import LLMRouter as InternalLLMRouter
+    from backend.app.models.context import (
+        ContextMessage,
+        LearningContext,
+        UIState,
+        VisualizationSpec,
+    )
+
+    # Force Pydantic to build validators now instead of on the first request.
+    LearningContext.model_rebuild()
+    VisualizationSpec.model_rebuild()
+except ImportError:
+    InternalLLMRouter = ContextMessage = LearningContext = UIState = VisualizationSpec = None
+
+
+def _context_from_trusted_dict(context_dict) -> "LearningContext":
+    """
+    Rebuilds a LearningContext without re-running Pydantic validation.
+
+    The dict comes from the FastAPI layer, which already validated the exact
+    same object before serializing it for this hop, so model_construct is
+    safe — but it is shallow, so the nested models are constructed
+    explicitly. Anything unexpected falls back to full validation.
+
+    Callers may also send the context pre-serialized as JSON bytes
+    (e.g. via orjson.dumps(context.model_dump(mode="json"))): those frames
+    are smaller on the wire and decode through Pydantic's C JSON validator,
+    which is faster than **dict expansion.
+    """
+    if isinstance(context_dict, (bytes, str)):
+        return LearningContext.model_validate_json(context_dict)
+    try:
+        fields = dict(context_dict)
+        fields["messages"] = [
+            ContextMessage.model_construct(**message)
+            for message in fields.get("messages") or []
+        ]
+        fields["ui_state"] = UIState.model_construct(**(fields.get("ui_state") or {}))
+        if fields.get("last_visualization_spec"):
+            fields["last_visualization_spec"] = VisualizationSpec.model_construct(
+                **fields["last_visualization_spec"]
+            )
+        return LearningContext.model_construct(**fields)
+    except (TypeError, AttributeError):
+        return LearningContext(**context_dict)
+
 # --- Modal App Definition ---
-# We define a single app object. Other Modal runner files can look this up
-# This approach keeps all our backend functions under one logical application.
+# This runner deploys as its own Modal app. Modal deployments are keyed by
+# app name and a deploy replaces the named app's whole function set, so the
+# LLM and Manim runners — two separate deploy files — must NOT share a
+# name: deploying one would silently delete the other's functions (the
+# backend looks up render_manim_scene on "VisualMathAi-backend").
 app = modal.App(
-    name="VisualMathAi-backend"
+    name="VisualMathAi-llm"
 )
 
+# --- Cross-Container Response Cache ---
+# A Modal Dict is shared by every container of this app, so a response
+# computed by one warm container is a hit for all of them. Keyed by a hash
+# of the full request triple; a repeated prompt skips the provider call
+# (and its cost/latency) entirely. Semantic near-duplicate matching is
+# handled upstream by SemanticCache in the FastAPI layer, so this tier
+# stays exact-match and dependency-free.
+response_cache = modal.Dict.from_name("llm-response-cache", create_if_missing=True)
+
+
+def _cache_key(provider_name: str, messages: List[Dict], context_dict: Dict) -> str:
+    """Stable digest of one inference request."""
+    payload = json.dumps(
+        {"p": provider_name, "m": messages, "c": context_dict},
+        sort_keys=True, default=str,
+    )
+    return hashlib.blake2b(payload.encode("utf-8"), digest_size=16).hexdigest()
+
+
+# --- Container-Scoped Event Loop and Router ---
+# asyncio.run() per call would build and tear down a fresh event loop each
+# time, dropping the HTTP connection pools the provider SDK clients keep on
+# it. On a keep_warm container handling many requests, one persistent loop
+# plus one lazily-built router lets TCP/TLS handshakes amortize across calls.
+# Modal runs concurrent inputs of a sync function on separate threads, so
+# the loop lives on its own dedicated thread and work is submitted to it
+# with run_coroutine_threadsafe — calling run_until_complete from several
+# threads at once would raise "This event loop is already running".
+_loop = asyncio.new_event_loop()
+_loop_thread = threading.Thread(target=_loop.run_forever, name="llm-loop", daemon=True)
+_loop_thread.start()
+_llm_router = None
+
+
+def _run_async(coro):
+    """Runs a coroutine on the shared loop thread and blocks for its result."""
+    return asyncio.run_coroutine_threadsafe(coro, _loop).result()
+
 # --- Remote Function Definition ---
 # This decorator turns the Python function into a serverless function on Modal.
 @app.function(
     secrets=[modal.Secret.from_dotenv()],
     
-    pip_install=["openai", "anthropic", "pydantic"],
+    pip_install=["openai", "anthropic", "pydantic", "orjson"],
     
     # Set resource limits and timeouts.
     timeout=120,  # Allow up to 2 minutes for an LLM response.
@@ -22,10 +125,10 @@ app = modal.App(
     memory=1024,  # Request 1GB of memory.
     
     # Keep the container warm for a few minutes to reduce cold start latency.
-    keep_warm=1,
+    keep_warm=_KEEP_WARM,
     
     # Allow multiple concurrent calls to this function.
-    allow_concurrent_inputs=10,
+    allow_concurrent_inputs=_CONCURRENT_INPUTS,
 )
 def generate_llm_response(provider_name: str, messages: List[Dict], context_dict: Dict) -> Union[str, Dict]:
     """
@@ -47,28 +150,42 @@ def generate_llm_response(provider_name: str, messages: List[Dict], context_dict
     # This code runs *inside the Modal container*.
     print(f"Modal function started for provider: {provider_name}")
 
-    # --- Re-import and Re-create Objects Inside the Remote Environment ---
-    from backend.app.api.llm.router import LLMRouter as InternalLLMRouter
-    from backend.app.models.context import LearningContext, VisualizationSpec
-
-    # The LLMRouter and its providers are initialized here, inside the Modal container.
+    # --- Response Cache Lookup ---
+    # Cache access is best-effort: a Dict hiccup must never fail the request.
+    cache_key = _cache_key(provider_name, messages, context_dict)
     try:
-        llm_router = InternalLLMRouter()
+        cached = response_cache.get(cache_key)
     except Exception as e:
-        # Handle initialization errors (e.g., missing dependencies in pip_install)
-        print(f"Error initializing LLM router on Modal: {e}")
-        raise
+        print(f"Response cache lookup failed (continuing uncached): {e}")
+        cached = None
+    if cached is not None:
+        print(f"Response cache hit for key {cache_key}.")
+        return cached
 
-    # Re-create the Pydantic model from the dictionary passed over the network.
+    # The LLMRouter is built once per container and reused across calls, so
+    # its provider clients (and their connection pools on _loop) stay warm.
+    global _llm_router
+    if _llm_router is None:
+        try:
+            _llm_router = InternalLLMRouter()
+        except Exception as e:
+            # Handle initialization errors (e.g., missing dependencies in pip_install)
+            print(f"Error initializing LLM router on Modal: {e}")
+            raise
+    llm_router = _llm_router
+
+    # Re-create the Pydantic model from the dictionary passed over the
+    # network. The FastAPI caller validated it already, so skip re-validation.
     try:
-        context = LearningContext(**context_dict)
+        context = _context_from_trusted_dict(context_dict)
     except Exception as e:
         print(f"Error validating context data on Modal: {e}")
         raise ValueError(f"Invalid context data received: {e}") from e
 
     # --- Execute the Core Logic ---
-    # Since the Modal function entrypoint is synchronous but our `route_request`
-    # is async, we use `asyncio.run` to execute it. 
+    # The Modal function entrypoint is synchronous but `route_request` is
+    # async; run it on the persistent container loop so connections opened
+    # during one call are still alive for the next.
     async def _run_async_logic():
         return await llm_router.route_request(
             provider_name=provider_name,
@@ -77,7 +194,7 @@ def generate_llm_response(provider_name: str, messages: List[Dict], context_dict
         )
 
     try:
-        result = asyncio.run(_run_async_logic())
+        result = _run_async(_run_async_logic())
     except Exception as e:
         # Catch errors from the LLM provider API calls
         print(f"Error during LLM API call on Modal: {e}")
@@ -88,7 +205,114 @@ def generate_llm_response(provider_name: str, messages: List[Dict], context_dict
     # --- Serialize the Return Value ---
     # If the result is a Pydantic model (VisualizationSpec), we must convert it
     # to a dictionary before returning it, as Modal needs to serialize the output.
+    # Only specs go into the shared cache: plain-string results can be
+    # provider error messages, and the Dict has no TTL to age them out.
     if isinstance(result, VisualizationSpec):
-        return result.model_dump()
+        result = result.model_dump()
+        try:
+            response_cache[cache_key] = result
+        except Exception as e:
+            print(f"Response cache write failed (response still returned): {e}")
+
+    return result
+
+
+@app.function(
+    secrets=[modal.Secret.from_dotenv()],
+    pip_install=["openai", "anthropic", "pydantic", "orjson"],
+    timeout=120,
+    cpu=1,
+    memory=1024,
+    keep_warm=_KEEP_WARM,
+    allow_concurrent_inputs=_CONCURRENT_INPUTS,
+)
+def generate_llm_response_stream(provider_name: str, messages: List[Dict], context_dict: Dict):
+    """
+    Streaming variant of generate_llm_response: a Modal generator that yields
+    frames as the provider produces tokens, so a caller using
+    `.remote_gen(...)` can relay text to the browser seconds before the full
+    response (and any trailing VisualizationSpec JSON) is complete.
+
+    Frames are dicts: {"type": "delta", "text": ...} per text chunk, then one
+    terminal {"type": "final", "spec": ...} or {"type": "final", "text": ...}.
+    """
+    global _llm_router
+    if _llm_router is None:
+        _llm_router = InternalLLMRouter()
+    llm_router = _llm_router
+
+    context = _context_from_trusted_dict(context_dict)
+    stream = llm_router.stream_request(
+        provider_name=provider_name, messages=messages, context=context
+    )
+
+    # Modal generator entrypoints are synchronous; pump the async iterator
+    # one event at a time on the persistent container loop.
+    while True:
+        try:
+            event = _run_async(stream.__anext__())
+        except StopAsyncIteration:
+            break
+        if event.get("type") == "text_delta":
+            yield {"type": "delta", "text": event["text"]}
+        elif event.get("type") == "result":
+            value = event["value"]
+            if isinstance(value, VisualizationSpec):
+                yield {"type": "final", "spec": value.model_dump()}
+            else:
+                yield {"type": "final", "text": value}
+
+
+@app.function(
+    secrets=[modal.Secret.from_dotenv()],
+    pip_install=["openai", "anthropic", "pydantic", "orjson"],
+    # Bulk jobs can legitimately take a while end to end.
+    timeout=600,
+    cpu=1,
+    memory=1024,
+)
+def generate_llm_response_batch(requests: List[Dict]) -> List[Union[str, Dict]]:
+    """
+    Fans a list of independent inference requests out on one container.
+
+    Each entry is a dict with 'provider_name', 'messages' and 'context_dict'
+    keys (the same triple generate_llm_response takes). The requests run
+    concurrently under a semaphore, so a 50-prompt bulk job costs one Modal
+    invocation instead of 50 container round-trips. Failed entries come back
+    as {"error": ...} dicts rather than aborting the batch.
+    """
+    global _llm_router
+    if _llm_router is None:
+        _llm_router = InternalLLMRouter()
+    llm_router = _llm_router
+
+    # Bound in-flight provider calls; beyond this, extra concurrency just
+    # trips provider-side rate limits.
+    sem = asyncio.Semaphore(8)
+
+    async def _one(request: Dict):
+        async with sem:
+            return await llm_router.route_request(
+                provider_name=request["provider_name"],
+                messages=request["messages"],
+                context=_context_from_trusted_dict(request["context_dict"]),
+            )
+
+    async def _run_batch():
+        return await asyncio.gather(
+            *(_one(request) for request in requests), return_exceptions=True
+        )
+
+    print(f"Modal batch function started for {len(requests)} requests.")
+    results = _run_async(_run_batch())
 
-    return result
\ No newline at end of file
+    serialized: List[Union[str, Dict]] = []
+    for result in results:
+        if isinstance(result, VisualizationSpec):
+            serialized.append(result.model_dump())
+        elif isinstance(result, BaseException):
+            serialized.append({"error": str(result)})
+        else:
+            serialized.append(result)
+    print("Modal batch function finished.")
+    return serialized
\ No newline at end of file